@@ -3,29 +3,143 @@ import numpy as np
 import json
 import requests
 import io
-import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
-import h5py
 import os
 from datetime import datetime
+from scipy.spatial import cKDTree
+from http_cache import HttpCache
+from geojson_writer import GeoJSONWriter
+from rain_polygons import save_polygon_geojson
+from radar_store import open_store
+from rain_render import FrameRenderer
+
+# Radar frames are published every 5 minutes under their local timestamp
+RADAR_URL = "http://www.weather.gov.sg/files/rainarea/50km/v2/dpsri_70km_{stamp}0000dBR.dpsri.png"
+FRAME_INTERVAL_MINUTES = 5
+
+def radar_url(frame_time, url_template=RADAR_URL):
+    return url_template.format(stamp=frame_time.strftime("%Y%m%d%H%M"))
+
+# Lookup table entry for colors further than max_distance from every palette color
+REJECTED = 255
 
 # Define a class to map RGB colors to magnitudes automatically
 class AutoColormap:
-    def __init__(self, rgb_colors):
+    def __init__(self, rgb_colors, max_distance=None):
         self.rgb_colors = rgb_colors
         self.rgb_array = np.array(rgb_colors) / 255.0  # Normalize RGB values to [0, 1]
         self.num_colors = len(rgb_colors)
+        # Colors further than max_distance (in 0-255 RGB units) from the palette are rejected as NaN
+        self.max_distance = max_distance
+
+        # Exact hits for palette colors; the first occurrence wins, as with argmin
+        self.exact_colors = {}
+        for idx, color in enumerate(pack_rgb(np.array(rgb_colors)).tolist()):
+            self.exact_colors.setdefault(color, idx + 1)
+        self.exact_keys = np.array(sorted(self.exact_colors), dtype=np.uint32)
+        self.exact_magnitudes = np.array([self.exact_colors[key] for key in self.exact_keys.tolist()], dtype=np.uint8)
+        # Nearest-color fallback for anti-aliased or compressed colors, over the distinct palette colors
+        self.palette = unpack_rgb(self.exact_keys) / 255.0
+        self.tree = cKDTree(unpack_rgb(self.exact_keys))
+
+        # Lookup table over packed 24-bit RGB values, filled lazily as new colors are seen.
+        # 0 marks a color that has not been classified yet (magnitudes start from 1)
+        self.lut = np.zeros(1 << 24, dtype=np.uint8)
+
+    def nearest(self, rgb, k=4):
+        # Magnitudes for (n, 3) colors in 0-255 units, REJECTED beyond max_distance.
+        # The tree narrows the palette to k candidates; equidistant colors are common on the
+        # integer RGB lattice, so the candidates are re-ranked exactly as to_magnitude does
+        k = min(k, len(self.exact_keys))
+        bound = np.inf if self.max_distance is None else self.max_distance
+        _, idx = self.tree.query(rgb, k=k, distance_upper_bound=bound)
+        idx = np.asarray(idx).reshape(len(rgb), k)
+        found = idx < len(self.exact_keys)
+        candidates = np.where(found, idx, 0)
+
+        distances = np.linalg.norm(self.palette[candidates] - (rgb / 255.0)[:, np.newaxis], axis=2)
+        distances[~found] = np.inf
+        magnitudes = np.where(found, self.exact_magnitudes[candidates], REJECTED)
+        # Lowest magnitude among the closest candidates, i.e. the first palette entry, like argmin
+        magnitudes = np.where(distances == distances.min(axis=1, keepdims=True), magnitudes, REJECTED)
+        return magnitudes.min(axis=1).astype(np.uint8)
 
     def to_magnitude(self, rgb_value):
-        # Find the index of the closest RGB color
-        idx = np.argmin(np.linalg.norm(self.rgb_array - (rgb_value / 255.0), axis=1))
-        # Return the corresponding magnitude, starting from 1
-        return idx + 1
+        rgb_value = np.asarray(rgb_value)
+        exact = self.exact_colors.get(int(pack_rgb(rgb_value)))
+        if exact is not None:
+            return exact
+        # Find the closest RGB color, the magnitude starts from 1
+        magnitude = self.nearest(rgb_value[np.newaxis, :3])[0]
+        return np.nan if magnitude == REJECTED else int(magnitude)
+
+    def to_magnitude_array(self, rgb_pixels):
+        """Classify a whole array of pixels (..., 3 or 4) in one pass.
+
+        Returns float magnitudes with the same leading shape, NaN for black pixels.
+        """
+        packed = pack_rgb(rgb_pixels)
+        self.fill_lut(packed)
+        magnitude = self.lut[packed].astype(np.float64)
+        magnitude[(packed == 0) | (magnitude == REJECTED)] = np.nan
+        return magnitude
+
+    def fill_lut(self, packed, chunk_size=65536):
+        # Only colors that were never seen before need a nearest-palette search
+        unique = np.unique(packed)
+        missing = unique[self.lut[unique] == 0]
+        # Palette colors resolve through the exact table without touching the tree
+        pos = np.minimum(np.searchsorted(self.exact_keys, missing), len(self.exact_keys) - 1)
+        hit = self.exact_keys[pos] == missing
+        self.lut[missing[hit]] = self.exact_magnitudes[pos[hit]]
+        missing = missing[~hit]
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            self.lut[chunk] = self.nearest(unpack_rgb(chunk))
+
+    def prebuild(self, chunk_size=1 << 20):
+        # Classify every 24-bit color up front, so no frame ever needs the tree
+        for start in range(0, 1 << 24, chunk_size):
+            self.fill_lut(np.arange(start, start + chunk_size, dtype=np.uint32))
+
+    def save_lut(self, path):
+        np.savez_compressed(path, lut=self.lut, colors=np.array(self.rgb_colors, dtype=np.uint8),
+                            max_distance=np.nan if self.max_distance is None else self.max_distance)
+
+    def load_lut(self, path):
+        """Use a table written by save_lut, if it was built for this palette and max_distance.
+
+        Returns whether it was loaded; a stale table is ignored and the lazy one kept.
+        """
+        with np.load(path) as table:
+            max_distance = float(table["max_distance"])
+            if not np.array_equal(table["colors"], np.array(self.rgb_colors)) or not (
+                    np.isnan(max_distance) if self.max_distance is None else max_distance == self.max_distance):
+                return False
+            self.lut = table["lut"]
+        return True
+
+def lut_file(color_file):
+    # The prebuilt lookup table of a palette file, written by legend_calibration.py
+    return os.path.splitext(color_file)[0] + ".lut.npz"
+
+def pack_rgb(rgb_pixels):
+    # Pack the RGB channels of (..., 3 or 4) pixels into single 24-bit integers
+    rgb = np.asarray(rgb_pixels)[..., :3].astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+def unpack_rgb(packed):
+    packed = np.asarray(packed, dtype=np.uint32)
+    return np.stack([(packed >> 16) & 255, (packed >> 8) & 255, packed & 255], axis=-1)
 
 class RainfallAnalyzer:
-    def __init__(self, color_file):
+    def __init__(self, color_file, max_distance=None, http_cache=None):
         self.extracted_colors = self.load_colors(color_file)
-        self.auto_cmap = AutoColormap(self.extracted_colors)
+        self.http_cache = http_cache
+        self.auto_cmap = AutoColormap(self.extracted_colors, max_distance)
+        # Start from the prebuilt lookup table of the palette when there is one
+        if os.path.exists(lut_file(color_file)):
+            self.auto_cmap.load_lut(lut_file(color_file))
         self.cmap = ListedColormap(np.array(self.extracted_colors) / 255.0)
         self.min_lat, self.max_lat = 1.47, 1.14
         self.min_lon, self.max_lon = 103.55, 104.1
@@ -37,6 +151,8 @@ class RainfallAnalyzer:
         return extracted_colors
 
     def fetch_image(self, url):
+        if self.http_cache is not None:
+            return Image.open(io.BytesIO(self.http_cache.get(url)))
         response = requests.get(url)
         if response.status_code == 200:
             image_bytes = response.content
@@ -44,96 +160,70 @@ class RainfallAnalyzer:
         else:
             raise Exception(f"Failed to fetch data: {response.status_code}")
 
-    def analyze_rainfall(self, image):
-        rain_data = np.array(image)
-        num_rows, num_cols = rain_data.shape[:2]
+    def grid_coordinates(self, num_rows, num_cols):
         latitudes = np.linspace(self.min_lat, self.max_lat, num_rows)
         longitudes = np.linspace(self.min_lon, self.max_lon, num_cols)
-        magnitude = np.empty([num_rows, num_cols])
-
-        for i in range(num_rows):
-            for j in range(num_cols):
-                rgb_value = rain_data[i, j][:3]
-                if sum(rgb_value) == 0:
-                    magnitude[i, j] = np.NaN
-                else:
-                    magnitude[i, j] = self.auto_cmap.to_magnitude(rgb_value)
-        
+        return latitudes, longitudes
+
+    def analyze_rainfall(self, image):
+        if image.mode == "P":
+            # Palette images: classify the (at most 256) palette entries once, then index by pixel
+            palette = np.zeros((256, 3), dtype=np.uint8)
+            entries = np.array(image.getpalette() or [], dtype=np.uint8).reshape(-1, 3)[:256]
+            palette[:len(entries)] = entries
+            magnitude = self.auto_cmap.to_magnitude_array(palette)[np.array(image)]
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGB")
+            magnitude = self.auto_cmap.to_magnitude_array(np.array(image))
+
+        latitudes, longitudes = self.grid_coordinates(*magnitude.shape)
         return magnitude, latitudes, longitudes
 
-    def save_geojson(self, magnitudes, latitudes, longitudes, output_file):
-        features = []
-        num_rows, num_cols = magnitudes.shape
-
-        for i in range(num_rows):
-            for j in range(num_cols):
-                if not np.isnan(magnitudes[i, j]):
-                    feature = {
-                        "type": "Feature",
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": [longitudes[j], latitudes[i]]
-                        },
-                        "properties": {
-                            "magnitude": magnitudes[i, j]
-                        }
-                    }
-                    features.append(feature)
-
-        geojson_data = {
-            "type": "FeatureCollection",
-            "features": features
-        }
-        
-        with open(output_file, "w") as f:
-            json.dump(geojson_data, f, indent=2)
+    def analyze_rainfall_batch(self, frames):
+        # Classify a stack of frames (N, H, W, 3 or 4) against the shared lookup table
+        magnitudes = self.auto_cmap.to_magnitude_array(frames)
+        latitudes, longitudes = self.grid_coordinates(*magnitudes.shape[1:])
+        return magnitudes, latitudes, longitudes
+
+    def save_geojson(self, magnitudes, latitudes, longitudes, output_file, precision=6, polygons=False, tolerance=0.0):
+        if polygons:
+            # One MultiPolygon per magnitude, traced from contiguous pixels (tolerance in pixels)
+            save_polygon_geojson(magnitudes, latitudes, longitudes, output_file, tolerance, precision)
+        else:
+            # Stream one Point per classified pixel; a .gz output file is gzipped
+            with GeoJSONWriter(output_file, precision=precision) as writer:
+                writer.write_grid(magnitudes, latitudes, longitudes, "magnitude", mask=~np.isnan(magnitudes))
         print("GeoJSON file saved:", output_file)
 
     def plot_magnitude(self, magnitude, output_file, title):
-        plt.figure(figsize=(10, 8))
-        plt.imshow(magnitude, cmap=self.cmap, aspect='auto')
-        plt.colorbar(label='Rain Magnitude')
-        plt.title(title)
-        plt.show()
-        plt.savefig(output_file)
+        # Headless Agg figure; use rain_render.FrameRenderer directly to plot many frames
+        FrameRenderer(self.cmap, magnitude.shape).save(magnitude, output_file, title)
         print("Plot saved:", output_file)
 
     def save_hdf5(self, magnitudes, latitudes, longitudes, datetime_str, output_file):
-        if not os.path.exists(output_file):
-            with h5py.File(output_file, 'w') as hf:
-                hf.create_dataset('magnitudes', data=magnitudes[np.newaxis, ...], maxshape=(None, magnitudes.shape[0], magnitudes.shape[1]))
-                hf.create_dataset('latitudes', data=latitudes)
-                hf.create_dataset('longitudes', data=longitudes)
-                hf.create_dataset('datetimes', data=np.array([datetime_str], dtype='S'))
-        else:
-            with h5py.File(output_file, 'a') as hf:
-                magnitudes_ds = hf['magnitudes']
-                magnitudes_ds.resize((magnitudes_ds.shape[0] + 1, magnitudes_ds.shape[1], magnitudes_ds.shape[2]))
-                magnitudes_ds[-1] = magnitudes
-
-                datetimes_ds = hf['datetimes']
-                datetimes_ds.resize((datetimes_ds.shape[0] + 1,))
-                datetimes_ds[-1] = np.string_(datetime_str)
-
-        print("HDF5 file saved/appended:", output_file)
+        # Frames already in the store are skipped, so re-running an ingest adds no duplicates
+        with open_store(output_file) as store:
+            added = store.append(magnitudes, [datetime_str], latitudes, longitudes)
+        print("HDF5 file saved/appended:" if added else "HDF5 file already has this frame:", output_file)
 
 def main():
     color_file = "extracted_colors.json"
     month, day, year, time = "05", "27", "2024", "1400"
     datetime_str = f"{year}-{month}-{day}T{time[:2]}:{time[2:]}:00"
     
-    rainfall_analyzer = RainfallAnalyzer(color_file)
+    rainfall_analyzer = RainfallAnalyzer(color_file, http_cache=HttpCache("cache"))
     
     # Construct the URL for the image
-    url = f"http://www.weather.gov.sg/files/rainarea/50km/v2/dpsri_70km_{year}{month}{day}{time}0000dBR.dpsri.png"
+    url = radar_url(datetime.strptime(datetime_str, "%Y-%m-%dT%H:%M:%S"))
     image = rainfall_analyzer.fetch_image(url)
     
     # Analyze rainfall
     magnitude, latitudes, longitudes = rainfall_analyzer.analyze_rainfall(image)
     
-    # Save GeoJSON
+    # Save GeoJSON rain areas
     geojson_output_file = f"outputs/rainfall_magnitude_{year}{month}{day}{time}.geojson"
-    rainfall_analyzer.save_geojson(magnitude, latitudes, longitudes, geojson_output_file)
+    rainfall_analyzer.save_geojson(magnitude, latitudes, longitudes, geojson_output_file, polygons=True)
     
     # Plot magnitude
     plot_output_file = f"outputs/rain_magnitude_plot_{year}{month}{day}{time}.png"
@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def tile_grid_shape(frame_shape, tile_size):
+    return (-(-frame_shape[0] // tile_size), -(-frame_shape[1] // tile_size))
+
+
+def pad_to_tiles(frame, tile_size, fill=0):
+    """Pad a (rows, cols) frame at the bottom/right to a whole number of tiles."""
+    tile_rows, tile_cols = tile_grid_shape(frame.shape, tile_size)
+    pad = ((0, tile_rows * tile_size - frame.shape[0]), (0, tile_cols * tile_size - frame.shape[1]))
+    if not any(p for _, p in pad):
+        return frame
+    return np.pad(frame, pad, constant_values=fill)
+
+
+def changed_tiles(previous, current, tile_size=32):
+    """Boolean (tile_rows, tile_cols) mask of the tiles that differ between two frames.
+
+    Frames are (rows, cols) magnitude grids or (rows, cols, channels) images. NaN compares
+    equal to NaN, so dry areas of magnitude grids count as unchanged.
+    """
+    if np.issubdtype(current.dtype, np.floating):
+        differs = ~((previous == current) | (np.isnan(previous) & np.isnan(current)))
+    else:
+        differs = previous != current
+    if differs.ndim > 2:
+        differs = differs.any(axis=tuple(range(2, differs.ndim)))
+    differs = pad_to_tiles(differs, tile_size, False)
+    tile_rows, tile_cols = tile_grid_shape(current.shape, tile_size)
+    return differs.reshape(tile_rows, tile_size, tile_cols, tile_size).any(axis=(1, 3))
+
+
+def expand_tiles(tile_mask, frame_shape, tile_size):
+    """Per-pixel mask (rows, cols) of the pixels covered by the selected tiles."""
+    pixels = np.repeat(np.repeat(tile_mask, tile_size, axis=0), tile_size, axis=1)
+    return pixels[:frame_shape[0], :frame_shape[1]]
+
+
+class IncrementalClassifier:
+    """Classify consecutive frames, re-classifying only the tiles that changed.
+
+    Consecutive radar frames are mostly identical (dry regions, slow cells), so each new
+    frame is compared tile by tile with the previous one and only changed tiles go
+    through the colour lookup; the others keep their previous magnitudes.
+    """
+
+    def __init__(self, analyzer, tile_size=32):
+        self.analyzer = analyzer
+        self.tile_size = tile_size
+        self.previous_rgb = None
+        self.previous_magnitude = None
+        self.last_changed_fraction = 1.0
+
+    def analyze_rainfall(self, image):
+        if image.mode == "P":
+            # Palette frames are classified through the palette already, nothing to save
+            return self.analyzer.analyze_rainfall(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        # Alpha is ignored by the classifier, so it is left out of the comparison too
+        rgb = np.array(image)[..., :3]
+
+        if self.previous_rgb is None or self.previous_rgb.shape != rgb.shape:
+            magnitude = self.analyzer.auto_cmap.to_magnitude_array(rgb)
+            self.last_changed_fraction = 1.0
+        else:
+            tiles = changed_tiles(self.previous_rgb, rgb, self.tile_size)
+            changed = expand_tiles(tiles, rgb.shape, self.tile_size)
+            magnitude = self.previous_magnitude.copy()
+            magnitude[changed] = self.analyzer.auto_cmap.to_magnitude_array(rgb[changed])
+            self.last_changed_fraction = tiles.mean()
+
+        self.previous_rgb = rgb
+        self.previous_magnitude = magnitude
+        latitudes, longitudes = self.analyzer.grid_coordinates(*magnitude.shape)
+        return magnitude, latitudes, longitudes
@@ -0,0 +1,114 @@
+import gzip
+
+import numpy as np
+
+
+class GeoJSONWriter:
+    """Stream a FeatureCollection to disk straight from NumPy arrays.
+
+    Features are formatted a chunk at a time from flat arrays, so no per-feature dicts are
+    built and memory stays constant however large the grid is. Output is one feature per
+    line with compact separators; files ending in .gz (or compress=True) are gzipped.
+
+    Usage:
+        with GeoJSONWriter("out.geojson", precision=5) as writer:
+            writer.write_grid(magnitudes, latitudes, longitudes, "magnitude")
+    """
+
+    def __init__(self, output_file, precision=6, compact=True, compress=None, chunk_size=65536):
+        self.output_file = output_file
+        self.precision = precision
+        self.chunk_size = chunk_size
+        self.count = 0
+        self.item_sep, self.key_sep = (",", ":") if compact else (", ", ": ")
+        if compress is None:
+            compress = output_file.endswith(".gz")
+        if compress:
+            self.file = gzip.open(output_file, "wt", encoding="utf-8")
+        else:
+            self.file = open(output_file, "w", encoding="utf-8")
+        self.file.write(self._json_object(type='"FeatureCollection"', features="[")[:-1] + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_points(self, longitudes, latitudes, **properties):
+        """Write one Point feature per element of the 1-D coordinate and property arrays.
+
+        Integer properties are written as integers, float properties with `precision`
+        significant digits. Mask out NaN values before calling, JSON has no NaN.
+        """
+        longitudes = np.asarray(longitudes, dtype=np.float64).ravel()
+        latitudes = np.asarray(latitudes, dtype=np.float64).ravel()
+        columns = [longitudes, latitudes]
+        value_formats = {}
+        for name, values in properties.items():
+            values = np.asarray(values).ravel()
+            value_formats[name] = "%d" if np.issubdtype(values.dtype, np.integer) else f"%.{self.precision}g"
+            columns.append(values.astype(np.float64))
+
+        coordinate_format = f"%.{self.precision}f"
+        template = self._json_object(
+            type='"Feature"',
+            geometry=self._json_object(
+                type='"Point"',
+                coordinates=f"[{coordinate_format}{self.item_sep}{coordinate_format}]",
+            ),
+            properties=self._json_object(**{name: fmt for name, fmt in value_formats.items()}),
+        )
+
+        for start in range(0, len(longitudes), self.chunk_size):
+            chunk = np.column_stack([column[start:start + self.chunk_size] for column in columns])
+            self._write_features(template, chunk)
+
+    def write_grid(self, values, latitudes, longitudes, name="value", mask=None):
+        """Write a (rows, cols) grid as Point features, row by row.
+
+        Coordinates are taken from the 1-D latitudes (rows) and longitudes (cols).
+        Cells where mask is False are skipped.
+        """
+        values = np.asarray(values)
+        latitudes = np.asarray(latitudes)
+        longitudes = np.asarray(longitudes)
+        num_cols = len(longitudes)
+        rows_per_chunk = max(1, self.chunk_size // max(num_cols, 1))
+
+        for start in range(0, values.shape[0], rows_per_chunk):
+            block = values[start:start + rows_per_chunk]
+            block_lat = np.repeat(latitudes[start:start + rows_per_chunk], num_cols)
+            block_lon = np.tile(longitudes, len(block))
+            block = block.ravel()
+            if mask is not None:
+                keep = np.asarray(mask[start:start + rows_per_chunk]).ravel()
+                block, block_lat, block_lon = block[keep], block_lat[keep], block_lon[keep]
+            self.write_points(block_lon, block_lat, **{name: block})
+
+    def write_raw_features(self, features):
+        """Write already serialized feature strings."""
+        for feature in features:
+            self._write(feature)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write("\n]}\n")
+        self.file.close()
+
+    def _write_features(self, template, chunk):
+        if not len(chunk):
+            return
+        # One formatting call per chunk instead of one json.dumps per feature
+        text = ",\n".join([template] * len(chunk)) % tuple(chunk.ravel().tolist())
+        self._write(text, len(chunk))
+
+    def _write(self, text, count=1):
+        if self.count:
+            self.file.write(",\n")
+        self.file.write(text)
+        self.count += count
+
+    def _json_object(self, **members):
+        return "{" + self.item_sep.join(f'"{key}"{self.key_sep}{value}' for key, value in members.items()) + "}"
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from geojson_writer import GeoJSONWriter
+from radar_store import from_epoch, to_epoch
+
+MAGIC = b"RAINGRID"
+# The values start at a multiple of this, so a memory map of them is aligned
+ALIGNMENT = 64
+
+
+def write_grid(output_file, values, latitudes, longitudes, times, name="value", variables=None, dtype=np.float32):
+    """Write interpolated fields on a regular lat/lon grid as one binary grid file.
+
+    values is (time, lat, lon), or (time, variables, lat, lon) with the variable names
+    in variables. The latitudes and longitudes must be evenly spaced; only their origin
+    and step are stored. times (one per frame, increasing) are kept as naive local epoch
+    seconds.
+
+    Layout: MAGIC, a little-endian uint32 header length, a JSON header (dtype, shape,
+    origin, step, times, name, variables) padded with spaces to ALIGNMENT, then the
+    values as one C-ordered array.
+    """
+    values = np.asarray(values)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    epochs = to_epoch(times)
+    if values.shape[0] != len(epochs) or values.shape[-2:] != (len(latitudes), len(longitudes)):
+        raise ValueError(f"values {values.shape} do not match {len(epochs)} times and a "
+                         f"{len(latitudes)}x{len(longitudes)} grid")
+    if np.any(np.diff(epochs) <= 0):
+        raise ValueError("times must be increasing")
+    steps = []
+    for axis in (latitudes, longitudes):
+        step = float(axis[1] - axis[0]) if len(axis) > 1 else 0.0
+        if not np.allclose(np.diff(axis), step, rtol=1e-6, atol=1e-9):
+            raise ValueError("latitudes and longitudes must be evenly spaced")
+        steps.append(step)
+
+    dtype = np.dtype(dtype).newbyteorder("<")
+    header = {
+        "dtype": dtype.str,
+        "shape": list(values.shape),
+        "origin": [float(latitudes[0]), float(longitudes[0])],
+        "step": steps,
+        "times": epochs.tolist(),
+        "name": name,
+        "variables": list(variables) if variables is not None else None,
+    }
+    text = json.dumps(header).encode()
+    prefix = len(MAGIC) + 4
+    text += b" " * (-(prefix + len(text)) % ALIGNMENT)
+    tmp_path = output_file + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint32(len(text)).astype("<u4").tobytes())
+        file.write(text)
+        file.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    os.replace(tmp_path, output_file)
+
+
+class GridFile:
+    """A grid file opened for reading; values is a read-only memory map, so slicing reads no more than it touches.
+
+    Usage:
+        grid = GridFile("outputs/estimated_rainfall.grid")
+        field = grid.frame("2024-05-27T14:05")              # (lat, lon) view
+        series = grid.values[:, row, col]                   # one cell over time
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a grid file")
+            length = int(np.frombuffer(file.read(4), dtype="<u4")[0])
+            self.header = json.loads(file.read(length))
+        self.name = self.header["name"]
+        self.variables = self.header["variables"]
+        self.epochs = np.array(self.header["times"], dtype=np.int64)
+        shape = tuple(self.header["shape"])
+        self.values = np.memmap(path, dtype=np.dtype(self.header["dtype"]), mode="r",
+                                offset=len(MAGIC) + 4 + length, shape=shape)
+
+    @property
+    def latitudes(self):
+        return self.header["origin"][0] + self.header["step"][0] * np.arange(self.values.shape[-2])
+
+    @property
+    def longitudes(self):
+        return self.header["origin"][1] + self.header["step"][1] * np.arange(self.values.shape[-1])
+
+    def times(self):
+        return from_epoch(self.epochs)
+
+    def frame_index(self, time):
+        epoch = to_epoch(time)[0]
+        index = int(np.searchsorted(self.epochs, epoch))
+        if index == len(self.epochs) or self.epochs[index] != epoch:
+            raise KeyError(f"No frame at {time}")
+        return index
+
+    def frame(self, time=None, variable=None):
+        """(lat, lon) values of one time (default the latest) and variable, as a view."""
+        values = self.values[-1 if time is None else self.frame_index(time)]
+        if self.variables is not None:
+            values = values[0 if variable is None else self.variables.index(variable)]
+        return values
+
+    def window(self, start=None, end=None):
+        """(times, values) of the frames with start <= time <= end, values a view."""
+        lo = 0 if start is None else int(np.searchsorted(self.epochs, to_epoch(start)[0], side="left"))
+        hi = len(self.epochs) if end is None else int(np.searchsorted(self.epochs, to_epoch(end)[0], side="right"))
+        return from_epoch(self.epochs[lo:hi]), self.values[lo:hi]
+
+    def cell(self, latitude, longitude):
+        """(row, col) of the cell nearest to a point."""
+        origin, step = self.header["origin"], self.header["step"]
+        indices = []
+        for value, start, delta, size in zip((latitude, longitude), origin, step, self.values.shape[-2:]):
+            indices.append(int(np.clip(np.rint((value - start) / delta) if delta else 0, 0, size - 1)))
+        return tuple(indices)
+
+
+def to_json(grid_path, output_file, time=None, variable=None):
+    """Write one frame in the legacy format: an indented list of {latitude, longitude, <name>}.
+
+    Cells without a value (NaN) are left out.
+    """
+    grid = GridFile(grid_path)
+    values = np.asarray(grid.frame(time, variable), dtype=np.float64)
+    name = variable or grid.name
+    rows, cols = np.nonzero(~np.isnan(values))
+    latitudes, longitudes = grid.latitudes, grid.longitudes
+    output_data = [{"latitude": float(latitudes[i]), "longitude": float(longitudes[j]), name: float(values[i, j])}
+                   for i, j in zip(rows.tolist(), cols.tolist())]
+    with open(output_file, "w") as outfile:
+        json.dump(output_data, outfile, indent=4)
+
+
+def to_geojson(grid_path, output_file, time=None, variable=None):
+    """Write one frame as a Point FeatureCollection, like the TPS scripts used to."""
+    grid = GridFile(grid_path)
+    values = np.asarray(grid.frame(time, variable))
+    with GeoJSONWriter(output_file) as writer:
+        writer.write_grid(values, grid.latitudes, grid.longitudes, variable or grid.name, mask=~np.isnan(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a binary grid file to the legacy JSON or GeoJSON")
+    parser.add_argument("grid", help="e.g. outputs/estimated_rainfall.grid")
+    parser.add_argument("--json", help="write the legacy list of points here")
+    parser.add_argument("--geojson", help="write a Point FeatureCollection here")
+    parser.add_argument("--time", help="frame time (default: latest)")
+    parser.add_argument("--variable", help="variable of a multi-variable grid (default: first)")
+    args = parser.parse_args()
+
+    grid = GridFile(args.grid)
+    print(f"{args.grid}: {grid.name} {grid.values.shape} {grid.values.dtype}, {grid.times()[0]} .. {grid.times()[-1]}")
+    if args.json:
+        to_json(args.grid, args.json, args.time, args.variable)
+        print("JSON saved:", args.json)
+    if args.geojson:
+        to_geojson(args.grid, args.geojson, args.time, args.variable)
+        print("GeoJSON saved:", args.geojson)
+
+
+if __name__ == "__main__":
+    main()
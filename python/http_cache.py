@@ -0,0 +1,202 @@
+import atexit
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+
+class HttpCache:
+    """Persistent, content-addressed cache for HTTP GET payloads.
+
+    Bodies are stored once per content hash under `objects/`, and `index.json` maps each
+    URL to its hash, validators (ETag / Last-Modified) and last access time. When the
+    stored payloads exceed `max_bytes`, the least recently used URLs are evicted.
+
+    Meant for one process at a time. Downloads and access times only update the index in
+    memory (kept in access order, with a running byte total), which is written at most
+    every `flush_interval` seconds, by flush(), on leaving a `with` block and at
+    interpreter exit, so eviction stays least recently used across runs.
+    """
+
+    def __init__(self, cache_dir="cache", max_bytes=2 * 1024 ** 3, flush_interval=60):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.session = requests.Session()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self._load_index()
+        # References and bytes per stored object, shared by URLs with identical payloads
+        self.refs = {}
+        self.total_bytes = 0
+        for entry in self.index.values():
+            self._add_ref(entry)
+        # Changes only touch the in-memory index until the next save
+        self.dirty = False
+        self.saved = time.time()
+        atexit.register(self.flush)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def get(self, url, max_age=None):
+        """Return the body of url, going to the network only when needed.
+
+        max_age=None trusts a cached copy forever (timestamped radar frames never change);
+        otherwise copies older than max_age seconds are revalidated with a conditional GET.
+        """
+        content = self.lookup(url, max_age)
+        if content is not None:
+            return content
+
+        entry = self.index.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.session.get(url, headers=headers)
+
+        if response.status_code == 304 and entry is not None:
+            content = self._read(entry)
+            if content is not None:
+                self.revalidations += 1
+                entry["fetched"] = entry["accessed"] = time.time()
+                self._touch(url)
+                return content
+            # The stored object went missing, fetch it again unconditionally
+            response = self.session.get(url)
+
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch data: {response.status_code}")
+        self.store(url, response.content, response.headers)
+        return response.content
+
+    def get_json(self, url, max_age=None):
+        return json.loads(self.get(url, max_age))
+
+    def lookup(self, url, max_age=None):
+        """Return the cached body of url if it is still fresh, without touching the network."""
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        if max_age is not None and time.time() - entry["fetched"] > max_age:
+            return None
+        content = self._read(entry)
+        if content is not None:
+            self.hits += 1
+            entry["accessed"] = time.time()
+            self._touch(url)
+        return content
+
+    def store(self, url, content, headers=None):
+        """Record a freshly downloaded body for url and evict old entries if over budget."""
+        headers = headers or {}
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        self.misses += 1
+        entry = {
+            "sha256": digest,
+            "size": len(content),
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "fetched": now,
+            "accessed": now,
+        }
+        # Referenced before the previous entry of url is dropped, which may share the object
+        self._add_ref(entry)
+        if url in self.index:
+            self._drop(url)
+        self.index[url] = entry
+        self._evict()
+        self._touch(url)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "entries": len(self.index),
+            "bytes": self.total_bytes,
+        }
+
+    def flush(self):
+        # Persist access times recorded by cache hits
+        if self.dirty:
+            self._save_index()
+
+    def _touch(self, url):
+        # Move url to the most recently used end (unless just evicted) and save if the last
+        # save is old enough
+        if url in self.index:
+            self.index[url] = self.index.pop(url)
+        self.dirty = True
+        if time.time() - self.saved > self.flush_interval:
+            self._save_index()
+
+    def _evict(self):
+        # The index is in access order, the least recently used URLs come first
+        while self.total_bytes > self.max_bytes:
+            self._drop(next(iter(self.index)))
+
+    def _add_ref(self, entry):
+        digest = entry["sha256"]
+        if digest not in self.refs:
+            self.total_bytes += entry["size"]
+        self.refs[digest] = self.refs.get(digest, 0) + 1
+
+    def _drop(self, url):
+        entry = self.index.pop(url)
+        digest = entry["sha256"]
+        self.refs[digest] -= 1
+        # Identical payloads are shared between URLs, drop the object once nobody uses it
+        if self.refs[digest] == 0:
+            del self.refs[digest]
+            self.total_bytes -= entry["size"]
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _read(self, entry):
+        try:
+            with open(self._object_path(entry["sha256"]), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return {}
+        with open(self.index_file, "r") as f:
+            index = json.load(f)
+        return dict(sorted(index.items(), key=lambda item: item[1]["accessed"]))
+
+    def _save_index(self):
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.index, f, separators=(",", ":"))
+        os.replace(tmp_file, self.index_file)
+        self.dirty = False
+        self.saved = time.time()
@@ -0,0 +1,96 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from PIL import Image
+
+from convert_color_array import AutoColormap, lut_file
+
+
+def legend_runs(image_array, threshold=24, min_fraction=0.75):
+    """(start, stop) columns of the color bands of a horizontal legend strip.
+
+    The strip is reduced to one color per column (the median over rows), and a new run
+    starts wherever neighbouring columns differ by more than threshold (summed over the
+    channels, 0-255 units). Tick lines and anti-aliased edges make runs of a pixel or two;
+    runs narrower than min_fraction of the typical band width are dropped, which also
+    drops bands cut off at either end of the strip.
+    """
+    profile = np.median(np.asarray(image_array)[..., :3].astype(np.float64), axis=0)
+    changes = np.abs(np.diff(profile, axis=0)).sum(axis=1) > threshold
+    boundaries = np.flatnonzero(changes) + 1
+    starts = np.concatenate([[0], boundaries])
+    stops = np.concatenate([boundaries, [len(profile)]])
+    widths = stops - starts
+    wide = widths[widths > 2]
+    if len(wide) == 0:
+        raise ValueError("No color bands found in the legend")
+    keep = widths >= min_fraction * np.median(wide)
+    return np.column_stack([starts[keep], stops[keep]])
+
+
+def legend_colors(image_array, threshold=24, min_fraction=0.75):
+    """RGB color of every band of the legend, in legend order, as an (n, 3) uint8 array.
+
+    Each color is the median over the band, so JPEG noise does not leak into the palette.
+    """
+    image_array = np.asarray(image_array)[..., :3]
+    runs = legend_runs(image_array, threshold, min_fraction)
+    colors = [np.median(image_array[:, start:stop].reshape(-1, 3), axis=0) for start, stop in runs]
+    return np.rint(colors).astype(np.uint8)
+
+
+def calibrate(legend_path, color_file="extracted_colors.json", max_distance=None, cache_dir="cache/palettes"):
+    """Extract the palette of a legend image and prebuild its classifier lookup table.
+
+    Writes color_file (legend order, as RainfallAnalyzer reads it) and the table next to
+    it (lut_file), which RainfallAnalyzer loads at startup. Both are cached on disk by the
+    legend image bytes and max_distance, so an unchanged legend is not segmented or
+    classified again. Returns the colors.
+    """
+    with open(legend_path, "rb") as file:
+        key = hashlib.sha256(file.read())
+    key.update(json.dumps(max_distance).encode())
+    cache_path = os.path.join(cache_dir, key.hexdigest() + ".npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            colors = cached["colors"][::-1]
+    else:
+        colors = legend_colors(np.array(Image.open(legend_path).convert("RGB")))
+        # The classifier numbers the colors from the end of the legend, as load_colors reverses them
+        auto_cmap = AutoColormap(colors[::-1].tolist(), max_distance)
+        auto_cmap.prebuild()
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".tmp.npz"
+        auto_cmap.save_lut(tmp_path)
+        os.replace(tmp_path, cache_path)
+
+    with open(color_file, "w") as file:
+        json.dump(colors.tolist(), file)
+    shutil.copyfile(cache_path, lut_file(color_file))
+    return colors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract the radar palette from the legend image and prebuild its lookup table")
+    parser.add_argument("legend", nargs="?", default="color_magnitude/color_magnitude.jpeg")
+    parser.add_argument("--output", default="extracted_colors.json", help="palette JSON; the table is written next to it")
+    parser.add_argument("--max-distance", type=float, help="reject colors further than this from the palette")
+    parser.add_argument("--cache-dir", default="cache/palettes")
+    parser.add_argument("--plot", help="save a swatch of the extracted colors here")
+    args = parser.parse_args()
+    colors = calibrate(args.legend, args.output, args.max_distance, args.cache_dir)
+    print(f"{len(colors)} colors:", args.output, lut_file(args.output))
+    if args.plot:
+        import matplotlib.pyplot as plt
+        plt.figure(figsize=(8, 1))
+        plt.imshow([colors], aspect="auto")
+        plt.yticks([])
+        plt.savefig(args.plot)
+
+
+if __name__ == "__main__":
+    main()
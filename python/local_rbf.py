@@ -0,0 +1,167 @@
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+from tps import PolynomialFeatures
+
+
+def wendland_kernel(r):
+    """Wendland C2 kernel (1 - r)^4 (4r + 1) for r < 1, 0 beyond; positive definite up to 3-D."""
+    r = np.minimum(r, 1.0)
+    return (1.0 - r) ** 4 * (4.0 * r + 1.0)
+
+
+def radial_kernel(dist, power):
+    """ThinPlateSpline's radial function: r^power, times log(r) for even powers."""
+    if power % 2:
+        return dist**power
+    dist = np.where(dist == 0, 1.0, dist)
+    return dist**power * np.log(dist)
+
+
+class LocalRBF:
+    """Partition of unity thin plate splines, a drop-in for ThinPlateSpline on many points.
+
+    The domain is covered by overlapping patches centred on a regular grid. Each patch
+    fits a small thin plate spline to the control points within its radius (at least the
+    `neighbors` nearest ones, found with a KD-tree), and a point's value blends the
+    patches covering it with compactly supported Wendland weights. The patch systems
+    keep about the same size whatever the number of control points (patches in clusters
+    much denser than the median grow) and are solved together in batches, so fit costs
+    O(n log n) instead of the O(n^3) of one global system, and
+    transform only evaluates the few patches around each point. The result still
+    interpolates every control point, and is as accurate as the global spline wherever
+    the field is resolved by `neighbors` points.
+
+    Same interface as ThinPlateSpline: fit(X, Y) returns self, transform(X) returns (n', v).
+    Patches work in coordinates scaled by their radius, so alpha > 0 smooths relative to
+    the patch size.
+    """
+
+    def __init__(self, alpha=0.0, neighbors=32, order=2, patch_batch=2048, chunk_size=4096):
+        self.alpha = alpha
+        self.neighbors = neighbors
+        self.order = order
+        self.patch_batch = patch_batch
+        self.chunk_size = chunk_size
+        self._fitted = False
+
+    def fit(self, X, Y):
+        X = _ensure_2d(np.asarray(X, dtype=np.float64))
+        Y = _ensure_2d(np.asarray(Y, dtype=np.float64))
+        if X.shape[0] != Y.shape[0]:
+            raise ValueError(f"X and Y should have the same number of points ({X.shape[0]} != {Y.shape[0]})")
+        num_points, dims = X.shape
+        self.power = self.order * 2 - dims
+        if self.power <= 0:
+            self.power = 2
+        self._polynomial_features = PolynomialFeatures(self.order - 1).fit(X)
+        self.control_points = X
+        tree = cKDTree(X)
+
+        # Radius holding about `neighbors` points at the median density; a grid spacing of
+        # radius / sqrt(dims) puts every point within half a radius of some patch centre
+        k = min(self.neighbors, num_points)
+        self.radius = float(np.median(_kth_distance(tree, X, k))) or 1.0
+        spacing = self.radius / np.sqrt(dims)
+        low, high = X.min(axis=0), X.max(axis=0)
+        axes = [lo + spacing * np.arange(int(np.ceil((hi - lo) / spacing)) + 1) for lo, hi in zip(low, high)]
+        self.centers = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, dims)
+        self.center_tree = cKDTree(self.centers)
+        # Sparse parts of the network get wider patches, so no patch is short of points
+        self.patch_radius = np.maximum(_kth_distance(tree, self.centers, k), self.radius)
+
+        members = tree.query_ball_point(self.centers, self.patch_radius)
+        self.patch_sizes = np.array([len(m) for m in members])
+        self.offsets = np.concatenate([[0], np.cumsum(self.patch_sizes)])
+        self.members = np.concatenate([np.asarray(m, dtype=np.intp) for m in members])
+
+        num_terms = self._polynomial_features.n_output_features
+        self.kernel_weights = np.empty((len(self.members), Y.shape[1]))
+        self.polynomial_weights = np.empty((len(self.centers), num_terms, Y.shape[1]))
+        # Patches of one size are solved as one batch of equal systems
+        for size in np.unique(self.patch_sizes):
+            patches = np.nonzero(self.patch_sizes == size)[0]
+            for start in range(0, len(patches), self.patch_batch):
+                self._fit_patches(patches[start:start + self.patch_batch], size, X, Y)
+        self._fitted = True
+        return self
+
+    def transform(self, X):
+        if not self._fitted:
+            raise RuntimeError("Please call `fit` before `transform`.")
+        X = _ensure_2d(np.asarray(X, dtype=np.float64))
+        if X.shape[1] != self.control_points.shape[1]:
+            raise ValueError(
+                f"The number of features do not match training data ({X.shape[1]} != {self.control_points.shape[1]})"
+            )
+        result = np.empty((len(X), self.kernel_weights.shape[1]))
+        # Chunks keep the (point, patch, member) entries of a large grid bounded
+        for start in range(0, len(X), self.chunk_size):
+            points = X[start:start + self.chunk_size]
+            result[start:start + len(points)] = self._transform_chunk(points)
+        return result
+
+    def _fit_patches(self, patches, size, X, Y):
+        num_terms = self._polynomial_features.n_output_features
+        index = self.members[self.offsets[patches][:, None] + np.arange(size)]
+        local = (X[index] - self.centers[patches, None]) / self.patch_radius[patches, None, None]
+        dist = np.linalg.norm(local[:, :, None] - local[:, None], axis=-1)
+        polynomial = self._polynomial_features.transform(local.reshape(-1, local.shape[-1])).reshape(
+            len(patches), size, num_terms)
+
+        # The ThinPlateSpline system A = [[K + alpha I, P], [P^T, 0]] of every patch
+        A = np.zeros((len(patches), size + num_terms, size + num_terms))
+        A[:, :size, :size] = radial_kernel(dist, self.power) + self.alpha * np.eye(size)
+        A[:, :size, size:] = polynomial
+        A[:, size:, :size] = polynomial.transpose(0, 2, 1)
+        rhs = np.zeros((len(patches), size + num_terms, Y.shape[1]))
+        rhs[:, :size] = Y[index]
+        try:
+            parameters = np.linalg.solve(A, rhs)
+        except np.linalg.LinAlgError:
+            # Some patch is degenerate (too few or collinear points): least squares one by one
+            parameters = np.stack([np.linalg.lstsq(a, b, rcond=None)[0] for a, b in zip(A, rhs)])
+        self.kernel_weights[self.offsets[patches][:, None] + np.arange(size)] = parameters[:, :size]
+        self.polynomial_weights[patches] = parameters[:, size:]
+
+    def _transform_chunk(self, points):
+        pairs = cKDTree(points).sparse_distance_matrix(self.center_tree, self.patch_radius.max(), output_type="ndarray")
+        rows, patches, dist = pairs["i"], pairs["j"], pairs["v"]
+        keep = dist < self.patch_radius[patches]
+        rows, patches = rows[keep], patches[keep]
+        blend = wendland_kernel(dist[keep] / self.patch_radius[patches])
+        uncovered = np.nonzero(np.bincount(rows, minlength=len(points)) == 0)[0]
+        if len(uncovered):
+            # Beyond every patch (far outside the control points): extrapolate the nearest one
+            _, nearest = self.center_tree.query(points[uncovered])
+            rows = np.concatenate([rows, uncovered])
+            patches = np.concatenate([patches, nearest])
+            blend = np.concatenate([blend, np.ones(len(uncovered))])
+
+        # One entry per (point, patch, patch member)
+        sizes = self.patch_sizes[patches]
+        pair_of_entry = np.repeat(np.arange(len(rows)), sizes)
+        entries = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes - self.offsets[patches], sizes)
+        scale = self.patch_radius[patches]
+        dist = np.linalg.norm(self.control_points[self.members[entries]] - points[rows[pair_of_entry]], axis=-1)
+        kernel = sparse.csr_matrix((radial_kernel(dist / scale[pair_of_entry], self.power), (pair_of_entry, entries)),
+                                   shape=(len(rows), len(self.members)))
+        local = (points[rows] - self.centers[patches]) / scale[:, None]
+        values = kernel @ self.kernel_weights + np.einsum(
+            "pt,ptv->pv", self._polynomial_features.transform(local), self.polynomial_weights[patches])
+
+        weights = sparse.csr_matrix((blend, (rows, np.arange(len(rows)))), shape=(len(points), len(rows)))
+        return (weights @ values) / np.asarray(weights.sum(axis=1))
+
+
+def _kth_distance(tree, points, k):
+    distances, _ = tree.query(points, k=k)
+    return distances.reshape(len(points), -1)[:, -1]
+
+
+def _ensure_2d(array):
+    if array.ndim not in (1, 2):
+        raise ValueError(f"Only supports 1d and 2d arrays. Found {array.ndim} dimensions.")
+    if array.ndim == 1:
+        array = array[:, None]
+    return array
@@ -1,21 +1,20 @@
 from PIL import Image
 import numpy as np
-import json
-import requests
 import io
 import geopandas as gpd
 import matplotlib.pyplot as plt
-from shapely.geometry import Point
+from convert_color_array import RainfallAnalyzer
+from rain_polygons import save_polygon_geojson
+from http_cache import HttpCache
 
 url = "http://www.weather.gov.sg/files/rainarea/50km/v2/dpsri_70km_2024052714000000dBR.dpsri.png"
-response = requests.get(url)
+# Frames are immutable once published, so a cached copy never needs revalidating
+http_cache = HttpCache("cache")
+try:
+    image_bytes = http_cache.get(url)
+except Exception as e:
+    print(e)
 
-if response.status_code == 200:
-    image_bytes = response.content
-else:
-    print("Failed to fetch data:", response.status_code)
-
-image_b = np.array(image_bytes)
 # Convert the image bytes to a PIL Image object
 image = Image.open(io.BytesIO(image_bytes))
 
@@ -27,26 +26,10 @@ image_array = np.array(image)
 min_lat, max_lat = 1.47, 1.14
 min_lon, max_lon = 103.55, 104.1
 
-# Load the extracted colors from the JSON file
-with open("extracted_colors.json", "r") as file:
-    extracted_colors = json.load(file)
-
-print(extracted_colors)
-
-#Define a mapping from pixel values to rainfall magnitudes using the extracted colors
-rainfall_magnitude_mapping = {}
-
-# Assign magnitudes to colors based on their order in the extracted colors list
-for i, color in enumerate(extracted_colors):
-    # Define a magnitude range for each color
-    # For simplicity, we'll use a range of (0, 5), (5, 10), (10, 15), and so on
-    # magnitude_range = (i * 5, (i + 1) * 5)
-    magnitude_range = i
-    # Add the color and its corresponding magnitude range to the mapping
-    rainfall_magnitude_mapping[tuple(color)] = magnitude_range
-
-print(rainfall_magnitude_mapping)
-# Now, rainfall_magnitude_mapping contains the mapping from colors to rainfall magnitudes
+# Classify pixels with the same palette index as convert_color_array.py, so both scripts agree.
+# Black pixels and colors that match no palette color closely enough are NaN
+rainfall_analyzer = RainfallAnalyzer("extracted_colors.json")
+magnitudes, _, _ = rainfall_analyzer.analyze_rainfall(image)
 
 # Convert pixel coordinates to geographical coordinates
 # Assuming the image covers the entire geographical extent
@@ -56,54 +39,20 @@ num_rows, num_cols = image_array.shape[:2]
 latitudes = np.linspace(min_lat, max_lat, num_rows)
 longitudes = np.linspace(min_lon, max_lon, num_cols)
 
-# Generate GeoJSON data
-features = []
-for i in range(num_rows):
-    for j in range(num_cols):
-        pixel_value = image_array[i, j]
-        magnitude = rainfall_magnitude_mapping.get(tuple(pixel_value[:3]), 0)  # Consider only RGB values
-        latitude = latitudes[i]
-        longitude = longitudes[j]
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [longitude, latitude]  # Note: GeoJSON coordinates are (lon, lat)
-            },
-            "properties": {
-                "magnitude": magnitude
-            }
-        }
-        features.append(feature)
-        # if sum(tuple(pixel_value[:3])) > 0:
-        #    print(tuple(pixel_value[:3]))
-
-# Create GeoJSON structure
-geojson_data = {
-    "type": "FeatureCollection",
-    "features": features
-}
-
-# Save GeoJSON to file
+# Save the rain areas as polygons, contiguous pixels of equal magnitude are merged
 output_file = "rainfall_magnitude.geojson"
-with open(output_file, "w") as f:
-    json.dump(geojson_data, f, indent=2)
+save_polygon_geojson(magnitudes, latitudes, longitudes, output_file)
 
 print("GeoJSON file saved:", output_file)
 
-# Convert GeoJSON to GeoDataFrame
-features = geojson_data["features"]
-geometry = [Point(feature["geometry"]["coordinates"]) for feature in features]
-properties = [feature["properties"] for feature in features]
-
-gdf = gpd.GeoDataFrame(properties, geometry=geometry)
+gdf = gpd.read_file(output_file)
 
 # Plotting
 fig, ax = plt.subplots(figsize=(10, 8))
 
 # Plot GeoDataFrame with magnitude as color, ensuring the "magnitude" column exists
 if 'magnitude' in gdf.columns:
-    gdf.plot(ax=ax, column='magnitude', legend=True, cmap='viridis', markersize=1)
+    gdf.plot(ax=ax, column='magnitude', legend=True, cmap='viridis')
 else:
     print("Error: 'magnitude' column not found in GeoDataFrame")
 
@@ -113,5 +62,6 @@ plt.ylabel('Latitude')
 plt.title('Rainfall Magnitude')
 
 # Show plot
-plt.show()
-plt.savefig('rain_magnitude_plot.png')
\ No newline at end of file
+# Save before showing, the figure is gone once the window is closed
+plt.savefig('rain_magnitude_plot.png')
+plt.show()
\ No newline at end of file
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import io
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import aiohttp
+import numpy as np
+from PIL import Image
+
+from convert_color_array import FRAME_INTERVAL_MINUTES, RADAR_URL, RainfallAnalyzer, radar_url
+from http_cache import HttpCache
+from radar_store import open_store
+
+# One analyzer per worker process, so its lookup table is reused across frames
+_worker_analyzer = None
+
+
+def _init_worker(color_file):
+    global _worker_analyzer
+    _worker_analyzer = RainfallAnalyzer(color_file)
+
+
+def classify_frame(image_bytes):
+    """Decode and classify one PNG frame inside a worker process."""
+    image = Image.open(io.BytesIO(image_bytes))
+    return _worker_analyzer.analyze_rainfall(image)
+
+
+def frame_times(start, end, interval_minutes=FRAME_INTERVAL_MINUTES):
+    """All frame timestamps from start to end inclusive, aligned to the frame interval."""
+    step = timedelta(minutes=interval_minutes)
+    # Round the start up to the next published frame
+    frame_time = start.replace(second=0, microsecond=0) - timedelta(minutes=start.minute % interval_minutes)
+    if frame_time < start:
+        frame_time += step
+    while frame_time <= end:
+        yield frame_time
+        frame_time += step
+
+
+async def fetch_frame(session, semaphore, url, http_cache=None):
+    # Frames downloaded by an earlier run are read back from the cache
+    if http_cache is not None:
+        content = http_cache.lookup(url)
+        if content is not None:
+            return content
+    # The semaphore bounds the number of requests in flight
+    async with semaphore:
+        async with session.get(url) as response:
+            if response.status == 404:
+                return None
+            if response.status != 200:
+                raise Exception(f"Failed to fetch data: {response.status}")
+            content = await response.read()
+    if http_cache is not None:
+        http_cache.store(url, content, response.headers)
+    return content
+
+
+async def process_frame(session, semaphore, pool, frame_time, url_template, http_cache=None):
+    image_bytes = await fetch_frame(session, semaphore, radar_url(frame_time, url_template), http_cache)
+    if image_bytes is None:
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, classify_frame, image_bytes)
+
+
+async def backfill(start, end, color_file="extracted_colors.json",
+                   output_file="outputs/rainfall_magnitudes.h5", url_template=RADAR_URL,
+                   concurrency=8, workers=None, http_cache=None, batch_size=64, delta=False):
+    """Fetch, classify and store every frame between start and end.
+
+    Frames are downloaded concurrently (at most `concurrency` requests in flight) and
+    classified on a process pool, but written to the HDF5 store strictly in time order,
+    `batch_size` frames per append. Frames already in the store are not fetched again.
+    A new store is delta-encoded against keyframes when delta=True.
+    Returns the list of frame times that were stored.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    stored = []
+    batch = []
+
+    with open_store(output_file, delta=delta) as store, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(color_file,)) as pool:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # Keep a bounded window of frames ahead of the writer, so memory stays flat
+            pending = deque()
+            try:
+                for frame_time in frame_times(start, end):
+                    if store.contains(frame_time):
+                        continue
+                    pending.append((frame_time, asyncio.create_task(
+                        process_frame(session, semaphore, pool, frame_time, url_template, http_cache))))
+                    if len(pending) >= 2 * concurrency:
+                        await _collect_next(pending, batch)
+                    if len(batch) >= batch_size:
+                        stored += _append_batch(store, batch)
+                while pending:
+                    await _collect_next(pending, batch)
+                stored += _append_batch(store, batch)
+            finally:
+                for _, task in pending:
+                    task.cancel()
+                if http_cache is not None:
+                    http_cache.flush()
+
+    return stored
+
+
+async def _collect_next(pending, batch):
+    frame_time, task = pending.popleft()
+    result = await task
+    if result is None:
+        print("Frame not available:", frame_time.isoformat())
+        return
+    batch.append((frame_time, result))
+
+
+def _append_batch(store, batch):
+    if not batch:
+        return []
+    times = [frame_time for frame_time, _ in batch]
+    magnitudes = np.stack([magnitude for _, (magnitude, _, _) in batch])
+    _, latitudes, longitudes = batch[0][1]
+    store.append(magnitudes, times, latitudes, longitudes)
+    print(f"Stored {len(times)} frames up to {times[-1].isoformat()}")
+    batch.clear()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill historical radar frames into the HDF5 store")
+    parser.add_argument("start", type=datetime.fromisoformat, help="first frame time, e.g. 2024-05-27T14:00")
+    parser.add_argument("end", type=datetime.fromisoformat, help="last frame time (inclusive)")
+    parser.add_argument("--color-file", default="extracted_colors.json")
+    parser.add_argument("--output", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--url-template", default=RADAR_URL,
+                        help="frame URL with a {stamp} placeholder, e.g. a local server serving fixture PNGs")
+    parser.add_argument("--concurrency", type=int, default=8, help="maximum requests in flight")
+    parser.add_argument("--workers", type=int, default=None, help="classification processes")
+    parser.add_argument("--cache-dir", default="cache", help="HTTP cache directory, '' to disable")
+    parser.add_argument("--batch-size", type=int, default=64, help="frames per HDF5 append")
+    parser.add_argument("--delta", action="store_true", help="create the store with keyframe + changed-tile encoding")
+    args = parser.parse_args()
+
+    http_cache = HttpCache(args.cache_dir) if args.cache_dir else None
+    stored = asyncio.run(backfill(args.start, args.end, args.color_file, args.output,
+                                  args.url_template, args.concurrency, args.workers, http_cache,
+                                  args.batch_size, args.delta))
+    print(f"Stored {len(stored)} frames")
+
+
+if __name__ == "__main__":
+    main()
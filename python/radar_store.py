@@ -0,0 +1,418 @@
+import os
+
+import h5py
+import numpy as np
+
+from frame_delta import changed_tiles, pad_to_tiles
+
+# Magnitudes start from 1, so 0 marks pixels without rain (NaN in analyze_rainfall)
+NODATA = 0
+
+
+def to_epoch(times):
+    """Convert datetimes, ISO strings or datetime64 values to int64 epoch seconds.
+
+    Frame times are naive local timestamps and are stored as such, without a timezone shift.
+    """
+    return np.array(times, dtype="datetime64[s]").astype(np.int64).reshape(-1)
+
+
+def from_epoch(epochs):
+    return np.asarray(epochs, dtype=np.int64).astype("datetime64[s]")
+
+
+def encode_magnitudes(magnitudes):
+    # Float magnitudes with NaN -> uint8 with the NODATA fill value
+    magnitudes = np.asarray(magnitudes)
+    if magnitudes.dtype == np.uint8:
+        return magnitudes
+    encoded = np.nan_to_num(magnitudes, nan=NODATA)
+    return encoded.astype(np.uint8)
+
+
+def decode_magnitudes(encoded):
+    magnitudes = encoded.astype(np.float64)
+    magnitudes[encoded == NODATA] = np.nan
+    return magnitudes
+
+
+class RadarStore:
+    """Time series of radar magnitude frames in one HDF5 file.
+
+    Layout:
+        magnitudes  uint8 (time, rows, cols), NODATA fill, chunked time-major and gzipped
+        times       int64 epoch seconds of each frame, unique
+        latitudes   float64 (rows,)
+        longitudes  float64 (cols,)
+
+    Frames are appended in batches and frames whose time is already stored are skipped,
+    so re-running an ingest is harmless. Files written by the old
+    RainfallAnalyzer.save_hdf5 (float64 magnitudes, byte-string datetimes) are migrated
+    when opened for writing.
+
+    Usage:
+        with RadarStore("outputs/rainfall_magnitudes.h5") as store:
+            store.append(magnitudes, times, latitudes, longitudes)
+            window, window_times, lats, lons = store.read("2024-05-27T12:00", "2024-05-27T14:00")
+    """
+
+    encoding = "full"
+
+    def __init__(self, path, mode="a", chunk_frames=16, chunk_pixels=128, compression_level=4):
+        self.path = path
+        self.mode = mode
+        self.chunk_frames = chunk_frames
+        self.chunk_pixels = chunk_pixels
+        self.compression_level = compression_level
+        if mode != "r" and os.path.exists(path):
+            self._migrate_legacy()
+        self.file = h5py.File(path, mode)
+        encoding = self.file.attrs.get("encoding", "full")
+        if "times" in self.file and encoding != self.encoding:
+            self.file.close()
+            raise ValueError(f"{path} holds {encoding}-encoded frames, open it with open_store()")
+        self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.epochs)
+
+    @property
+    def shape(self):
+        if "latitudes" not in self.file:
+            return (0, 0, 0)
+        return (len(self.epochs), len(self.file["latitudes"]), len(self.file["longitudes"]))
+
+    @property
+    def latitudes(self):
+        return self.file["latitudes"][:]
+
+    @property
+    def longitudes(self):
+        return self.file["longitudes"][:]
+
+    def times(self):
+        """All stored frame times in time order."""
+        return from_epoch(self.epochs[self.order])
+
+    def contains(self, time):
+        return int(to_epoch(time)[0]) in self.epoch_set
+
+    def append(self, magnitudes, times, latitudes=None, longitudes=None):
+        """Append a batch of frames (n, rows, cols) with their n times.
+
+        Float magnitudes are encoded to uint8 (NaN -> NODATA). Frames whose time is already
+        stored, or repeated within the batch, are skipped. Returns the number of frames written.
+        """
+        magnitudes = np.asarray(magnitudes)
+        if magnitudes.ndim == 2:
+            magnitudes = magnitudes[np.newaxis]
+        epochs = to_epoch(times)
+        if len(epochs) != len(magnitudes):
+            raise ValueError(f"Got {len(magnitudes)} frames but {len(epochs)} times")
+
+        # Enforce unique times, against the store and within the batch
+        keep, seen = [], set(self.epoch_set)
+        for i, epoch in enumerate(epochs.tolist()):
+            if epoch not in seen:
+                keep.append(i)
+                seen.add(epoch)
+        if not keep:
+            return 0
+        frames = encode_magnitudes(magnitudes[keep])
+        epochs = epochs[keep]
+
+        if "times" not in self.file:
+            if latitudes is None or longitudes is None:
+                raise ValueError("latitudes and longitudes are required for the first append")
+            self._create(frames.shape[1:], latitudes, longitudes)
+        elif frames.shape[1:] != self.shape[1:]:
+            raise ValueError(f"Frame shape {frames.shape[1:]} does not match the store {self.shape[1:]}")
+
+        # One resize and one write for the whole batch
+        self._write_frames(frames)
+        times_ds = self.file["times"]
+        start = times_ds.shape[0]
+        times_ds.resize(start + len(frames), axis=0)
+        times_ds[start:] = epochs
+        self.file.flush()
+
+        self.epochs = np.concatenate([self.epochs, epochs])
+        self.epoch_set.update(epochs.tolist())
+        self.order = np.argsort(self.epochs, kind="stable")
+        return len(frames)
+
+    def frame_indices(self, start=None, end=None):
+        """Storage indices of the frames with start <= time <= end, in time order."""
+        sorted_epochs = self.epochs[self.order]
+        lo = 0 if start is None else np.searchsorted(sorted_epochs, to_epoch(start)[0], side="left")
+        hi = len(sorted_epochs) if end is None else np.searchsorted(sorted_epochs, to_epoch(end)[0], side="right")
+        return self.order[lo:hi]
+
+    def bbox_slices(self, bbox):
+        """Row and column slices covering bbox = (lat_a, lat_b, lon_a, lon_b), in any order."""
+        return (_axis_slice(self.latitudes, bbox[0], bbox[1]),
+                _axis_slice(self.longitudes, bbox[2], bbox[3]))
+
+    def read(self, start=None, end=None, bbox=None, raw=False):
+        """Read the frames in a time window, optionally cropped to a lat/lon bbox.
+
+        Only the chunks overlapping the window and bbox are read from disk.
+        Returns (magnitudes, times, latitudes, longitudes); magnitudes are float with NaN
+        for no rain, or the stored uint8 values when raw=True.
+        """
+        indices = self.frame_indices(start, end)
+        rows, cols = (slice(None), slice(None)) if bbox is None else self.bbox_slices(bbox)
+        frames = self._read_frames(indices, rows, cols)
+        latitudes, longitudes = self.latitudes[rows], self.longitudes[cols]
+        times = from_epoch(self.epochs[indices])
+        return (frames if raw else decode_magnitudes(frames)), times, latitudes, longitudes
+
+    def read_points(self, rows, cols, start=None, end=None):
+        """Raw uint8 values of the pixels (rows[i], cols[i]) over a time window.
+
+        Points are grouped by storage block, so every block holding points is read once
+        for the whole window. Returns (values (time, points), times).
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        cols = np.asarray(cols, dtype=np.int64).reshape(-1)
+        indices = self.frame_indices(start, end)
+        values = np.full((len(indices), len(rows)), NODATA, dtype=np.uint8)
+        row_block, col_block = self._point_block()
+        keys = (rows // row_block) * (self.shape[2] // col_block + 1) + cols // col_block
+        for key in np.unique(keys):
+            members = np.nonzero(keys == key)[0]
+            r0, c0 = rows[members].min(), cols[members].min()
+            window = self._read_frames(indices, slice(r0, rows[members].max() + 1),
+                                       slice(c0, cols[members].max() + 1))
+            values[:, members] = window[:, rows[members] - r0, cols[members] - c0]
+        return values, from_epoch(self.epochs[indices])
+
+    def _point_block(self):
+        return self.file["magnitudes"].chunks[1:]
+
+    def _write_frames(self, frames):
+        magnitudes_ds = self.file["magnitudes"]
+        start = magnitudes_ds.shape[0]
+        magnitudes_ds.resize(start + len(frames), axis=0)
+        magnitudes_ds[start:] = frames
+
+    def _read_frames(self, indices, rows, cols):
+        magnitudes_ds = self.file["magnitudes"]
+        if len(indices) == 0:
+            return np.zeros((0,) + magnitudes_ds[0:0, rows, cols].shape[1:], dtype=np.uint8)
+        # The usual case: frames were appended in time order, read one contiguous block
+        if np.all(np.diff(indices) == 1):
+            return magnitudes_ds[indices[0]:indices[-1] + 1, rows, cols]
+        # h5py needs increasing indices; read in storage order and put back in time order
+        storage_order = np.argsort(indices)
+        frames = magnitudes_ds[np.sort(indices), rows, cols]
+        result = np.empty_like(frames)
+        result[storage_order] = frames
+        return result
+
+    def _create(self, frame_shape, latitudes, longitudes):
+        num_rows, num_cols = frame_shape
+        chunks = (self.chunk_frames, min(num_rows, self.chunk_pixels), min(num_cols, self.chunk_pixels))
+        magnitudes_ds = self.file.create_dataset(
+            "magnitudes", shape=(0, num_rows, num_cols), maxshape=(None, num_rows, num_cols),
+            dtype=np.uint8, chunks=chunks, fillvalue=NODATA,
+            compression="gzip", compression_opts=self.compression_level,
+        )
+        magnitudes_ds.attrs["nodata"] = NODATA
+        self._create_axes(latitudes, longitudes)
+
+    def _create_axes(self, latitudes, longitudes):
+        self.file.attrs["encoding"] = self.encoding
+        times_ds = self.file.create_dataset(
+            "times", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,),
+        )
+        times_ds.attrs["units"] = "seconds since 1970-01-01T00:00:00 (local frame time)"
+        self.file.create_dataset("latitudes", data=np.asarray(latitudes, dtype=np.float64))
+        self.file.create_dataset("longitudes", data=np.asarray(longitudes, dtype=np.float64))
+
+    def _load_index(self):
+        self.epochs = self.file["times"][:] if "times" in self.file else np.zeros(0, dtype=np.int64)
+        self.epoch_set = set(self.epochs.tolist())
+        self.order = np.argsort(self.epochs, kind="stable")
+
+    def _migrate_legacy(self, batch_size=256):
+        with h5py.File(self.path, "r") as legacy:
+            if "datetimes" not in legacy or "times" in legacy:
+                return
+        tmp_path = self.path + ".migrating"
+        with h5py.File(self.path, "r") as legacy, RadarStore(tmp_path, "w", self.chunk_frames,
+                                                             self.chunk_pixels, self.compression_level) as store:
+            datetimes = [value.decode() for value in legacy["datetimes"][:]]
+            for start in range(0, len(datetimes), batch_size):
+                store.append(legacy["magnitudes"][start:start + batch_size], datetimes[start:start + batch_size],
+                             legacy["latitudes"][:], legacy["longitudes"][:])
+        os.replace(tmp_path, self.path)
+
+
+class DeltaRadarStore(RadarStore):
+    """RadarStore variant that keeps only the tiles that changed since a keyframe.
+
+    Every `keyframe_interval`-th frame is stored whole; the frames in between store the
+    tile_size x tile_size tiles that differ from their keyframe. Dry regions and slowly
+    moving cells leave most tiles untouched, so continuous ingest writes a fraction of
+    the pixels. Reads rebuild frames from keyframe + tiles and only fetch the tiles that
+    overlap the requested bbox.
+
+    Layout (besides times, latitudes and longitudes):
+        keyframes       uint8 (keyframes, rows, cols) whole frames
+        keyframe_of     int64 (time,) keyframe each frame is relative to
+        tile_start      int64 (time,) first delta tile of each frame
+        tile_count      int64 (time,) number of delta tiles of each frame
+        tiles           uint8 (tiles, tile_size, tile_size) changed tile contents
+        tile_positions  int32 (tiles, 2) tile row and column of each delta tile
+    """
+
+    encoding = "delta"
+
+    def __init__(self, path, mode="a", keyframe_interval=12, tile_size=32, compression_level=4):
+        self.keyframe_interval = keyframe_interval
+        self.tile_size = tile_size
+        self._keyframe = None
+        super().__init__(path, mode, compression_level=compression_level)
+        if "tiles" in self.file:
+            self.keyframe_interval = int(self.file.attrs["keyframe_interval"])
+            self.tile_size = int(self.file.attrs["tile_size"])
+
+    def _create(self, frame_shape, latitudes, longitudes):
+        num_rows, num_cols = frame_shape
+        tile = self.tile_size
+        compression = dict(compression="gzip", compression_opts=self.compression_level)
+        self.file.create_dataset("keyframes", shape=(0, num_rows, num_cols), maxshape=(None, num_rows, num_cols),
+                                 dtype=np.uint8, chunks=(1, num_rows, num_cols), fillvalue=NODATA, **compression)
+        self.file.create_dataset("tiles", shape=(0, tile, tile), maxshape=(None, tile, tile),
+                                 dtype=np.uint8, chunks=(64, tile, tile), fillvalue=NODATA, **compression)
+        self.file.create_dataset("tile_positions", shape=(0, 2), maxshape=(None, 2), dtype=np.int32,
+                                 chunks=(4096, 2), **compression)
+        for name in ("keyframe_of", "tile_start", "tile_count"):
+            self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+        self.file.attrs["keyframe_interval"] = self.keyframe_interval
+        self.file.attrs["tile_size"] = self.tile_size
+        self.file.attrs["nodata"] = NODATA
+        self._create_axes(latitudes, longitudes)
+
+    def _write_frames(self, frames):
+        keyframes_ds, keyframe_of_ds = self.file["keyframes"], self.file["keyframe_of"]
+        tiles_ds, positions_ds = self.file["tiles"], self.file["tile_positions"]
+        frame_index = keyframe_of_ds.shape[0]
+        keyframe_of, tile_start, tile_count, tiles, positions = [], [], [], [], []
+        next_tile = tiles_ds.shape[0]
+
+        for frame in frames:
+            if frame_index % self.keyframe_interval == 0 or keyframes_ds.shape[0] == 0:
+                keyframes_ds.resize(keyframes_ds.shape[0] + 1, axis=0)
+                keyframes_ds[-1] = frame
+                self._keyframe = (keyframes_ds.shape[0] - 1, pad_to_tiles(frame, self.tile_size, NODATA))
+                changed = np.zeros((0, 2), dtype=np.int32)
+            else:
+                keyframe_index, keyframe = self._current_keyframe()
+                padded = pad_to_tiles(frame, self.tile_size, NODATA)
+                changed = np.argwhere(changed_tiles(keyframe, padded, self.tile_size)).astype(np.int32)
+                tile = self.tile_size
+                for row, col in changed:
+                    tiles.append(padded[row * tile:(row + 1) * tile, col * tile:(col + 1) * tile])
+                positions.append(changed)
+            keyframe_of.append(self._keyframe[0])
+            tile_start.append(next_tile)
+            tile_count.append(len(changed))
+            next_tile += len(changed)
+            frame_index += 1
+
+        if tiles:
+            start = tiles_ds.shape[0]
+            tiles_ds.resize(start + len(tiles), axis=0)
+            tiles_ds[start:] = np.stack(tiles)
+            positions_ds.resize(start + len(tiles), axis=0)
+            positions_ds[start:] = np.concatenate(positions)
+        for name, values in (("keyframe_of", keyframe_of), ("tile_start", tile_start), ("tile_count", tile_count)):
+            dataset = self.file[name]
+            dataset.resize(dataset.shape[0] + len(values), axis=0)
+            dataset[-len(values):] = values
+
+    def _point_block(self):
+        return self.tile_size, self.tile_size
+
+    def _current_keyframe(self):
+        if self._keyframe is None:
+            keyframes_ds = self.file["keyframes"]
+            index = keyframes_ds.shape[0] - 1
+            self._keyframe = (index, pad_to_tiles(keyframes_ds[index], self.tile_size, NODATA))
+        return self._keyframe
+
+    def _read_frames(self, indices, rows, cols):
+        num_rows, num_cols = self.shape[1:]
+        row_range = range(num_rows)[rows]
+        col_range = range(num_cols)[cols]
+        frames = np.empty((len(indices), len(row_range), len(col_range)), dtype=np.uint8)
+        if len(indices) == 0 or not len(row_range) or not len(col_range):
+            return frames
+        r0, r1 = row_range.start, row_range.stop
+        c0, c1 = col_range.start, col_range.stop
+
+        keyframe_of = self.file["keyframe_of"][:]
+        tile_start = self.file["tile_start"][:]
+        tile_count = self.file["tile_count"][:]
+        tile = self.tile_size
+        # Only tiles overlapping the requested rows/cols matter
+        first_tile_row, last_tile_row = r0 // tile, (r1 - 1) // tile
+        first_tile_col, last_tile_col = c0 // tile, (c1 - 1) // tile
+
+        keyframe_cache = {}
+        for n, index in enumerate(indices):
+            keyframe_index = keyframe_of[index]
+            if keyframe_index not in keyframe_cache:
+                keyframe_cache = {keyframe_index: self.file["keyframes"][keyframe_index, r0:r1, c0:c1]}
+            frame = keyframe_cache[keyframe_index].copy()
+
+            start, count = tile_start[index], tile_count[index]
+            if count:
+                positions = self.file["tile_positions"][start:start + count]
+                overlap = np.nonzero((positions[:, 0] >= first_tile_row) & (positions[:, 0] <= last_tile_row)
+                                     & (positions[:, 1] >= first_tile_col) & (positions[:, 1] <= last_tile_col))[0]
+                if len(overlap):
+                    tiles = self.file["tiles"][start + overlap[0]:start + overlap[-1] + 1][overlap - overlap[0]]
+                    for (row, col), content in zip(positions[overlap], tiles):
+                        # Paste the part of the tile inside the requested window
+                        tr0, tc0 = row * tile, col * tile
+                        pr0, pr1 = max(tr0, r0), min(tr0 + tile, r1)
+                        pc0, pc1 = max(tc0, c0), min(tc0 + tile, c1)
+                        frame[pr0 - r0:pr1 - r0, pc0 - c0:pc1 - c0] = content[pr0 - tr0:pr1 - tr0, pc0 - tc0:pc1 - tc0]
+            frames[n] = frame
+        return frames
+
+
+def open_store(path, mode="a", delta=False, **kwargs):
+    """Open a radar store with the encoding it was written in.
+
+    New files are created as DeltaRadarStore when delta=True, as RadarStore otherwise.
+    """
+    encoding = None
+    if os.path.exists(path):
+        with h5py.File(path, "r") as f:
+            # Files from the old save_hdf5 layout (datetimes) are migrated to the full encoding
+            encoding = f.attrs.get("encoding", "full") if ("times" in f or "datetimes" in f) else None
+    if encoding == "delta" or (encoding is None and delta):
+        return DeltaRadarStore(path, mode, **kwargs)
+    return RadarStore(path, mode, **kwargs)
+
+
+def _axis_slice(axis, a, b):
+    # Coordinate axes are linear but may run in either direction (latitudes decrease with row)
+    lo, hi = min(a, b), max(a, b)
+    inside = np.nonzero((axis >= lo) & (axis <= hi))[0]
+    if len(inside) == 0:
+        return slice(0, 0)
+    return slice(int(inside[0]), int(inside[-1]) + 1)
@@ -0,0 +1,141 @@
+import argparse
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from convert_color_array import FRAME_INTERVAL_MINUTES, RADAR_URL, RainfallAnalyzer, radar_url
+from http_cache import HttpCache
+from radar_backfill import frame_times
+from frame_delta import IncrementalClassifier
+from radar_store import from_epoch, open_store
+from rain_accumulation import RollingAccumulator
+
+# Frame file names use Singapore local time
+FRAME_TIMEZONE = ZoneInfo("Asia/Singapore")
+
+
+class RadarTail:
+    """Keep the radar store up to date with newly published frames.
+
+    Every poll looks at the expected frame times since the newest stored frame (and at
+    least the last `give_up_after`, so overdue frames are retried) and ingests only those
+    missing from the store's time index. Because the store itself is the only state, a
+    restarted tail resumes where the previous one stopped; after an outage longer than
+    `lookback` it resumes at `lookback` and warns, the rest is left to radar_backfill.
+
+    Latency is measured per frame from publication (the Last-Modified header, or the
+    nominal frame time without one or without an http_cache) to the HDF5 commit, and
+    frames over `latency_budget` seconds are reported.
+    """
+
+    def __init__(self, store_path="outputs/rainfall_magnitudes.h5", color_file="extracted_colors.json",
+                 http_cache=None, url_template=RADAR_URL, latency_budget=120, poll_interval=20,
+                 lookback=timedelta(hours=2), give_up_after=timedelta(minutes=30), delta=False,
+                 rolling=False):
+        self.store_path = store_path
+        self.analyzer = RainfallAnalyzer(color_file, http_cache=http_cache)
+        # Consecutive frames share most tiles, only the changed ones are classified again
+        self.classifier = IncrementalClassifier(self.analyzer)
+        self.delta = delta
+        self.url_template = url_template
+        self.latency_budget = latency_budget
+        self.poll_interval = poll_interval
+        self.lookback = lookback
+        self.give_up_after = give_up_after
+        # Frames that never showed up, not worth asking for again
+        self.given_up = set()
+        self.latencies = deque(maxlen=288)
+        # Rolling accumulations, brought up to date after every poll that stored frames
+        self.accumulator = RollingAccumulator(store_path) if rolling else None
+
+    def now(self):
+        return datetime.now(FRAME_TIMEZONE).replace(tzinfo=None)
+
+    def missing_frames(self, now):
+        """Expected frame times since the newest stored frame that are not stored yet."""
+        with open_store(self.store_path, delta=self.delta) as store:
+            start = now - self.lookback
+            if len(store):
+                newest = from_epoch(store.epochs.max()).item()
+                if newest < start:
+                    print(f"Newest stored frame {newest.isoformat()} is older than the lookback, "
+                          f"frames up to {start.isoformat()} are left to radar_backfill")
+                start = max(start, min(newest, now - self.give_up_after))
+            return [frame_time for frame_time in frame_times(start, now)
+                    if frame_time not in self.given_up and not store.contains(frame_time)]
+
+    def poll_once(self, now=None):
+        """Ingest every missing frame that is available. Returns the frame times stored."""
+        now = now or self.now()
+        stored = []
+        for frame_time in self.missing_frames(now):
+            url = radar_url(frame_time, self.url_template)
+            try:
+                image = self.analyzer.fetch_image(url)
+            except Exception as e:
+                # Not published yet, or a gap in the archive
+                if now - frame_time > self.give_up_after:
+                    print(f"Giving up on frame {frame_time.isoformat()}: {e}")
+                    self.given_up.add(frame_time)
+                continue
+
+            magnitude, latitudes, longitudes = self.classifier.analyze_rainfall(image)
+            with open_store(self.store_path, delta=self.delta) as store:
+                store.append(magnitude, [frame_time], latitudes, longitudes)
+            self._record_latency(frame_time, url)
+            stored.append(frame_time)
+        if stored and self.accumulator is not None:
+            self.accumulator.update()
+        return stored
+
+    def run(self):
+        print(f"Tailing radar frames into {self.store_path}")
+        while True:
+            self.poll_once()
+            # Wake up for the next expected frame, or keep polling while one is overdue
+            now = self.now()
+            next_frame = next(frame_times(now, now + timedelta(minutes=FRAME_INTERVAL_MINUTES)))
+            time.sleep(min(self.poll_interval, max((next_frame - now).total_seconds(), 1)))
+
+    def _record_latency(self, frame_time, url):
+        published = frame_time
+        http_cache = self.analyzer.http_cache
+        last_modified = http_cache.index.get(url, {}).get("last_modified") if http_cache is not None else None
+        if last_modified:
+            published = parsedate_to_datetime(last_modified).astimezone(FRAME_TIMEZONE).replace(tzinfo=None)
+        latency = (self.now() - published).total_seconds()
+        self.latencies.append(latency)
+        status = "OVER BUDGET" if latency > self.latency_budget else "ok"
+        print(f"Frame {frame_time.isoformat()} committed {latency:.1f}s after publish ({status}, "
+              f"p95 {np.percentile(self.latencies, 95):.1f}s over {len(self.latencies)} frames)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest new radar frames as they are published")
+    parser.add_argument("--color-file", default="extracted_colors.json")
+    parser.add_argument("--output", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--url-template", default=RADAR_URL)
+    parser.add_argument("--latency-budget", type=float, default=120,
+                        help="seconds from frame publish to HDF5 commit")
+    parser.add_argument("--poll-interval", type=float, default=20, help="seconds between polls")
+    parser.add_argument("--lookback-minutes", type=int, default=120,
+                        help="how far back missing frames are picked up on (re)start")
+    parser.add_argument("--cache-dir", default="", help="HTTP cache directory, '' to disable")
+    parser.add_argument("--delta", action="store_true", help="create the store with keyframe + changed-tile encoding")
+    parser.add_argument("--rolling", action="store_true", help="keep rolling accumulations next to the store")
+    args = parser.parse_args()
+
+    http_cache = HttpCache(args.cache_dir) if args.cache_dir else None
+    tail = RadarTail(args.output, args.color_file, http_cache, url_template=args.url_template,
+                     latency_budget=args.latency_budget, poll_interval=args.poll_interval,
+                     lookback=timedelta(minutes=args.lookback_minutes), delta=args.delta,
+                     rolling=args.rolling)
+    tail.run()
+
+
+if __name__ == "__main__":
+    main()
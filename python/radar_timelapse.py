@@ -0,0 +1,96 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from PIL import Image
+
+from convert_color_array import RainfallAnalyzer
+from radar_store import from_epoch, open_store
+from rain_render import FrameRenderer
+
+# One renderer per worker process, so the figure is built once and reused for every frame
+_worker_renderer = None
+_worker_store_path = None
+
+
+def _init_worker(store_path, color_file):
+    global _worker_renderer, _worker_store_path
+    with open_store(store_path, mode="r") as store:
+        latitudes, longitudes = store.latitudes, store.longitudes
+    extent = [longitudes[0], longitudes[-1], latitudes[-1], latitudes[0]]
+    _worker_renderer = FrameRenderer(RainfallAnalyzer(color_file).cmap, (len(latitudes), len(longitudes)), extent)
+    _worker_store_path = store_path
+
+
+def render_frames(first_index, times, output_dir):
+    """Render the stored frames at the given times to numbered PNGs inside a worker."""
+    with open_store(_worker_store_path, mode="r") as store:
+        frames, frame_times, _, _ = store.read(times[0], times[-1])
+    output_files = []
+    for n, (magnitude, frame_time) in enumerate(zip(frames, frame_times)):
+        output_file = os.path.join(output_dir, f"frame_{first_index + n:05d}.png")
+        title = f"Rain Levels {frame_time.astype(datetime):%Y/%m/%d Time: %H%M}"
+        _worker_renderer.save(magnitude, output_file, title)
+        output_files.append(output_file)
+    return output_files
+
+
+def render_store(store_path, output_dir, color_file="extracted_colors.json", start=None, end=None,
+                 workers=None, batch_frames=32):
+    """Render every stored frame in a time window to output_dir/frame_NNNNN.png.
+
+    Frames are numbered in time order, so the directory can be fed to ffmpeg as is
+    (ffmpeg -framerate 8 -i frame_%05d.png timelapse.mp4). Returns the PNG paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open_store(store_path, mode="r") as store:
+        times = from_epoch(store.epochs[store.frame_indices(start, end)])
+
+    output_files = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(store_path, color_file)) as pool:
+        batches = [pool.submit(render_frames, i, times[i:i + batch_frames], output_dir)
+                   for i in range(0, len(times), batch_frames)]
+        for batch in batches:
+            output_files += batch.result()
+    return output_files
+
+
+def save_gif(frame_files, output_file, frame_duration=125, max_frames=600):
+    """Assemble rendered frames into a looping GIF, frame_duration in milliseconds.
+
+    Frames are opened and quantized one at a time, but Pillow holds every GIF frame until
+    the file is written, so longer runs are thinned to every n-th frame to stay within
+    max_frames (the PNGs stay complete). Returns the number of frames in the GIF.
+    """
+    step = -(-len(frame_files) // max_frames)
+    frame_files = frame_files[::step]
+    frames = (Image.open(frame_file).convert("P", palette=Image.Palette.ADAPTIVE) for frame_file in frame_files)
+    next(frames).save(output_file, save_all=True, append_images=frames, duration=frame_duration, loop=0)
+    return len(frame_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render stored radar frames to a time-lapse")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--color-file", default="extracted_colors.json")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="first frame time, e.g. 2024-05-27T12:00")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="last frame time (inclusive)")
+    parser.add_argument("--frames-dir", default="outputs/timelapse")
+    parser.add_argument("--gif", default="outputs/timelapse.gif", help="'' to only write the PNG frames")
+    parser.add_argument("--gif-max-frames", type=int, default=600,
+                        help="longer runs are thinned to every n-th frame in the GIF, which is held in memory "
+                             "while it is written (the PNG frames are all kept)")
+    parser.add_argument("--workers", type=int, default=None, help="rendering processes")
+    args = parser.parse_args()
+
+    frame_files = render_store(args.store, args.frames_dir, args.color_file, args.start, args.end, args.workers)
+    print(f"Rendered {len(frame_files)} frames into {args.frames_dir}")
+    if args.gif and frame_files:
+        num_frames = save_gif(frame_files, args.gif, max_frames=args.gif_max_frames)
+        print(f"Time-lapse saved: {args.gif} ({num_frames} frames)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import argparse
+import os
+
+import h5py
+import numpy as np
+
+from radar_store import NODATA, from_epoch, open_store, to_epoch
+
+# Rolling windows, in seconds, each ending at the latest frame
+WINDOWS = {"1h": 3600, "3h": 3 * 3600, "24h": 24 * 3600}
+
+
+def accumulate(store, start=None, end=None, batch_frames=64):
+    """Sum, rain-frame count and maximum of the stored magnitudes over a time window.
+
+    Frames are read batch_frames at a time, so any window fits in memory. Returns
+    {"sum": uint32, "count": uint16, "max": uint8} rasters (rows, cols).
+    """
+    times = from_epoch(store.epochs[store.frame_indices(start, end)])
+    shape = store.shape[1:]
+    totals = {"sum": np.zeros(shape, dtype=np.uint32), "count": np.zeros(shape, dtype=np.uint16),
+              "max": np.zeros(shape, dtype=np.uint8)}
+    for i in range(0, len(times), batch_frames):
+        batch = times[i:i + batch_frames]
+        frames, _, _, _ = store.read(batch[0], batch[-1], raw=True)
+        totals["sum"] += frames.sum(axis=0, dtype=np.uint32)
+        totals["count"] += (frames != NODATA).sum(axis=0, dtype=np.uint16)
+        np.maximum(totals["max"], frames.max(axis=0), out=totals["max"])
+    return totals
+
+
+class RollingAccumulator:
+    """Rolling sums, rain-frame counts and maxima of the radar store, updated per frame.
+
+    Each window of WINDOWS covers the frames in (end - window, end], end being the latest
+    ingested frame. A new frame is added to every sum and count, and the frames it pushes
+    out of a window are read back from the store and subtracted, so an update costs a few
+    frames whatever the window length.
+
+    Maxima cannot be subtracted. Instead the time each pixel last reached every magnitude
+    level is kept; those times fall with the level, so the maximum over any window is the
+    number of levels reached since the window start. One such array serves all windows.
+
+    The state lives in output_file (default: next to the store, *_rolling.h5) together
+    with the window rasters, and is rebuilt from the store when frames older than end
+    show up (a backfill) or the file is missing.
+    """
+
+    def __init__(self, store_path="outputs/rainfall_magnitudes.h5", output_file=None, windows=WINDOWS, levels=30):
+        self.store_path = store_path
+        self.output_file = output_file or os.path.splitext(store_path)[0] + "_rolling.h5"
+        self.windows = dict(windows)
+        self.levels = levels
+        self.end = None
+        self.frames_seen = 0
+        self.sums, self.counts = {}, {}
+        # Epoch minutes each pixel last reached magnitude >= level + 1, int32 to keep it small
+        self.last_seen = None
+        self._load()
+
+    def update(self):
+        """Fold the frames stored since the last update into the windows.
+
+        Returns the number of frames added.
+        """
+        with open_store(self.store_path, mode="r") as store:
+            if len(store) == 0:
+                return 0
+            sorted_epochs = store.epochs[store.order]
+            seen = 0 if self.end is None else int(np.searchsorted(sorted_epochs, self.end, side="right"))
+            if self.end is None or seen != self.frames_seen:
+                # First run, or frames were inserted before end: start over from the store
+                self._rebuild(store, int(sorted_epochs[-1]))
+                added = len(store)
+            else:
+                new_epochs = sorted_epochs[seen:]
+                for epoch in new_epochs.tolist():
+                    self._add_frame(store, epoch)
+                added = len(new_epochs)
+            self.frames_seen = len(store)
+        if added:
+            self._save()
+        return added
+
+    def rasters(self, window):
+        """{"sum", "count", "max", "mean"} rasters of one window; mean is NaN where dry."""
+        count = self.counts[window]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, self.sums[window] / count, np.nan)
+        return {"sum": self.sums[window], "count": count, "max": self.window_max(window), "mean": mean}
+
+    def window_max(self, window):
+        start_minute = (self.end - self.windows[window]) // 60
+        return (self.last_seen > start_minute).sum(axis=0, dtype=np.uint8)
+
+    def _add_frame(self, store, epoch):
+        frame = store.read(from_epoch(epoch), from_epoch(epoch), raw=True)[0][0]
+        for name, seconds in self.windows.items():
+            self.sums[name] += frame
+            self.counts[name] += frame != NODATA
+            # Frames that drop out of the window, normally exactly one
+            leaving = store.read(from_epoch(self.end - seconds + 1), from_epoch(epoch - seconds), raw=True)[0]
+            if len(leaving):
+                self.sums[name] -= leaving.sum(axis=0, dtype=np.uint32)
+                self.counts[name] -= (leaving != NODATA).sum(axis=0, dtype=np.uint16)
+        self._mark_levels(frame[np.newaxis], np.array([epoch]))
+        self.end = epoch
+
+    def _mark_levels(self, frames, epochs):
+        # For every level, the latest of these frames at or above it
+        top = int(frames.max(initial=0))
+        if top > len(self.last_seen):
+            grow = np.full((top - len(self.last_seen),) + self.last_seen.shape[1:], np.iinfo(np.int32).min, np.int32)
+            self.last_seen = np.concatenate([self.last_seen, grow])
+        minutes = (np.asarray(epochs) // 60).astype(np.int32)
+        for level in range(1, top + 1):
+            reached = frames >= level
+            any_reached = reached.any(axis=0)
+            latest = len(frames) - 1 - np.argmax(reached[::-1], axis=0)
+            self.last_seen[level - 1][any_reached] = minutes[latest[any_reached]]
+
+    def _rebuild(self, store, end):
+        shape = store.shape[1:]
+        self.end = end
+        for name, seconds in self.windows.items():
+            totals = accumulate(store, from_epoch(end - seconds + 1), from_epoch(end))
+            self.sums[name], self.counts[name] = totals["sum"], totals["count"]
+        self.last_seen = np.full((self.levels,) + shape, np.iinfo(np.int32).min, dtype=np.int32)
+        longest = max(self.windows.values())
+        times = from_epoch(store.epochs[store.frame_indices(from_epoch(end - longest + 1), from_epoch(end))])
+        for i in range(0, len(times), 64):
+            frames, batch_times, _, _ = store.read(times[i], times[min(i + 63, len(times) - 1)], raw=True)
+            self._mark_levels(frames, to_epoch(batch_times))
+
+    def _load(self):
+        if not os.path.exists(self.output_file):
+            return
+        with h5py.File(self.output_file, "r") as f:
+            if sorted(f.attrs.get("windows", [])) != sorted(self.windows) or any(
+                    int(f[name].attrs["seconds"]) != seconds for name, seconds in self.windows.items()):
+                return
+            self.end = int(f.attrs["end"])
+            self.frames_seen = int(f.attrs["frames_seen"])
+            self.last_seen = f["last_seen"][:]
+            for name in self.windows:
+                self.sums[name] = f[name]["sum"][:]
+                self.counts[name] = f[name]["count"][:]
+
+    def _save(self):
+        tmp_path = self.output_file + ".tmp"
+        compression = dict(compression="gzip", compression_opts=4)
+        with h5py.File(tmp_path, "w") as f:
+            f.attrs["end"] = self.end
+            f.attrs["end_time"] = str(from_epoch(self.end))
+            f.attrs["frames_seen"] = self.frames_seen
+            f.attrs["windows"] = list(self.windows)
+            f.create_dataset("last_seen", data=self.last_seen, **compression)
+            for name, seconds in self.windows.items():
+                group = f.create_group(name)
+                group.attrs["seconds"] = seconds
+                group.create_dataset("sum", data=self.sums[name], **compression)
+                group.create_dataset("count", data=self.counts[name], **compression)
+                group.create_dataset("max", data=self.window_max(name), **compression)
+        os.replace(tmp_path, self.output_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling rain accumulations over the radar store")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--output", default=None, help="aggregate file (default: <store>_rolling.h5)")
+    parser.add_argument("--start", help="recompute one historical window from this time instead")
+    parser.add_argument("--end", help="end of the historical window (inclusive)")
+    args = parser.parse_args()
+
+    if args.start or args.end:
+        output = args.output or "outputs/rainfall_accumulation.npz"
+        with open_store(args.store, mode="r") as store:
+            totals = accumulate(store, args.start, args.end)
+        np.savez_compressed(output, **totals)
+        print(f"Accumulation {args.start} .. {args.end} saved: {output}")
+        return
+
+    accumulator = RollingAccumulator(args.store, args.output)
+    added = accumulator.update()
+    print(f"Rolling windows up to {from_epoch(accumulator.end)}: {added} frames added, saved to {accumulator.output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+
+from convert_color_array import FRAME_INTERVAL_MINUTES
+from frame_delta import pad_to_tiles
+from radar_store import NODATA, RadarStore, from_epoch, open_store, to_epoch
+
+
+def extract_tiles(frames, tile_size, stride):
+    """Overlapping (n, tile_rows, tile_cols, tile_size, tile_size) tiles of (n, rows, cols) frames."""
+    padded = np.stack([pad_to_tiles(frame, stride) for frame in frames])
+    if padded.shape[1] < tile_size or padded.shape[2] < tile_size:
+        padded = np.pad(padded, ((0, 0), (0, max(tile_size - padded.shape[1], 0)),
+                                 (0, max(tile_size - padded.shape[2], 0))))
+    return sliding_window_view(padded, (tile_size, tile_size), axis=(1, 2))[:, ::stride, ::stride]
+
+
+def tile_motion(frames, tile_size=64, stride=32, min_rain_fraction=0.05):
+    """Displacement per frame interval of every tile, by FFT phase correlation.
+
+    frames is (n, rows, cols) consecutive frames, float with NaN or raw uint8 with NODATA
+    for no rain. The normalised cross-power spectra of all consecutive pairs and all
+    tiles are computed in one batch and averaged per tile, so the peak reflects the
+    motion over the whole history. Returns (row_shift, col_shift) arrays of
+    (tile_rows, tile_cols), NaN for tiles with too little rain to tell.
+    """
+    frames = np.asarray(frames)
+    rain = frames != NODATA if frames.dtype == np.uint8 else ~np.isnan(frames)
+    fields = np.where(rain, frames, 0).astype(np.float32)
+    tiles = extract_tiles(fields, tile_size, stride)
+    rain_fraction = extract_tiles(rain.astype(np.float32), tile_size, stride).mean(axis=(-2, -1))
+
+    # Remove the tile mean and taper the edges, so the tile border does not correlate with itself
+    window = np.outer(np.hanning(tile_size), np.hanning(tile_size)).astype(np.float32)
+    tiles = (tiles - tiles.mean(axis=(-2, -1), keepdims=True)) * window
+    spectra = np.fft.rfft2(tiles, axes=(-2, -1))
+    cross = spectra[1:] * np.conj(spectra[:-1])
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    correlation = np.fft.irfft2(cross.mean(axis=0), s=(tile_size, tile_size), axes=(-2, -1))
+
+    tile_rows, tile_cols = correlation.shape[:2]
+    flat = correlation.reshape(tile_rows, tile_cols, -1)
+    peak = np.argmax(flat, axis=-1)
+    peak_row, peak_col = np.divmod(peak, tile_size)
+    shifts = []
+    for peak_axis, axis in ((peak_row, -2), (peak_col, -1)):
+        # Parabolic fit through the peak and its neighbours (with wraparound) for sub-pixel shifts
+        center = np.take_along_axis(flat, peak[..., None], -1)[..., 0]
+        before, after = [np.take_along_axis(np.roll(correlation, step, axis=axis).reshape(tile_rows, tile_cols, -1),
+                                            peak[..., None], -1)[..., 0] for step in (1, -1)]
+        curvature = before - 2 * center + after
+        offset = np.where(curvature < 0, 0.5 * (before - after) / np.where(curvature < 0, curvature, 1), 0)
+        shift = peak_axis + offset
+        shifts.append(np.where(shift > tile_size / 2, shift - tile_size, shift))
+
+    enough_rain = (rain_fraction >= min_rain_fraction).all(axis=0)
+    return tuple(np.where(enough_rain, shift, np.nan) for shift in shifts)
+
+
+def motion_field(row_shift, col_shift, frame_shape, tile_size=64, stride=32):
+    """Per-pixel (rows, cols) displacement fields from the tile motion.
+
+    Tiles without an estimate take the mean motion of the others (no motion when no
+    tile has one), and the tile vectors are bilinearly interpolated between tile centres.
+    """
+    fields = []
+    for shift in (row_shift, col_shift):
+        valid = ~np.isnan(shift)
+        fields.append(np.where(valid, shift, shift[valid].mean() if valid.any() else 0.0))
+    rows, cols = np.indices(frame_shape, dtype=np.float32)
+    # Pixel coordinates in tile units, tile i being centred on pixel i * stride + tile_size / 2
+    tile_coordinates = [(rows - (tile_size - 1) / 2) / stride, (cols - (tile_size - 1) / 2) / stride]
+    return tuple(ndimage.map_coordinates(field, tile_coordinates, order=1, mode="nearest") for field in fields)
+
+
+def advect(frame, motion, lead_steps):
+    """Semi-Lagrangian extrapolation of a raw uint8 frame, one frame interval per step.
+
+    Departure points are traced back through the motion field one step at a time and the
+    latest frame is sampled (nearest pixel, magnitudes stay classes) at the departure
+    point, so no smoothing accumulates over the steps. Rain arriving from outside the
+    grid is unknown and left as NODATA. Yields the forecast of each lead step.
+    """
+    row_motion, col_motion = motion
+    rows, cols = np.indices(frame.shape, dtype=np.float32)
+    departure_rows, departure_cols = rows, cols
+    for _ in range(lead_steps):
+        coordinates = [departure_rows, departure_cols]
+        departure_rows = departure_rows - ndimage.map_coordinates(row_motion, coordinates, order=1, mode="nearest")
+        departure_cols = departure_cols - ndimage.map_coordinates(col_motion, coordinates, order=1, mode="nearest")
+        yield ndimage.map_coordinates(frame, [departure_rows, departure_cols], order=0, mode="constant", cval=NODATA)
+
+
+def nowcast(store_path="outputs/rainfall_magnitudes.h5", output_dir="outputs/nowcast", lead_minutes=60,
+            history=4, issue_time=None, tile_size=64, stride=32):
+    """Extrapolate the latest stored frame lead_minutes ahead.
+
+    Motion is estimated from the last `history` frames up to issue_time (default the
+    latest). The forecast is written as a radar store of its own, one frame per frame
+    interval at its valid time, in output_dir/nowcast_<issue time>.h5. Returns that path.
+    """
+    with open_store(store_path, mode="r") as store:
+        end = issue_time or store.times()[-1]
+        indices = store.frame_indices(None, end)[-history:]
+        times = from_epoch(store.epochs[indices])
+        frames, times, latitudes, longitudes = store.read(times[0], times[-1], raw=True)
+    if len(frames) < 2:
+        raise ValueError("Need at least two stored frames to estimate motion")
+    interval = np.timedelta64(FRAME_INTERVAL_MINUTES * 60, "s")
+    if np.any(np.diff(times) != interval):
+        print(f"Warning: frames {times[0]} .. {times[-1]} are not {FRAME_INTERVAL_MINUTES} minutes apart")
+
+    row_shift, col_shift = tile_motion(frames, tile_size, stride)
+    motion = motion_field(row_shift, col_shift, frames.shape[1:], tile_size, stride)
+    lead_steps = lead_minutes // FRAME_INTERVAL_MINUTES
+    forecast = np.stack(list(advect(frames[-1], motion, lead_steps)))
+    valid_times = times[-1] + interval * np.arange(1, lead_steps + 1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, f"nowcast_{times[-1].astype(datetime):%Y%m%d%H%M}.h5")
+    with RadarStore(output_file, "w") as output:
+        output.append(forecast, valid_times, latitudes, longitudes)
+        output.file.attrs["issue_time"] = to_epoch(times[-1])[0]
+    return output_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extrapolation nowcast from the latest stored radar frames")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--output-dir", default="outputs/nowcast")
+    parser.add_argument("--lead-minutes", type=int, default=60)
+    parser.add_argument("--history", type=int, default=4, help="frames used to estimate motion")
+    parser.add_argument("--issue-time", help="nowcast from the frames up to this time (default: latest)")
+    parser.add_argument("--tile-size", type=int, default=64)
+    args = parser.parse_args()
+
+    output_file = nowcast(args.store, args.output_dir, args.lead_minutes, args.history, args.issue_time,
+                          args.tile_size, args.tile_size // 2)
+    print("Nowcast saved:", output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+import numpy as np
+from scipy import ndimage
+
+from geojson_writer import GeoJSONWriter
+
+# Boundary edge directions, in clockwise order so that (d + 3) % 4 is a left turn
+EAST, SOUTH, WEST, NORTH = range(4)
+
+
+def label_regions(magnitudes):
+    """Label 4-connected regions of equal magnitude; NaN cells get label 0.
+
+    Returns the label raster and the magnitude of each label (index 0 unused).
+    """
+    labels = np.zeros(magnitudes.shape, dtype=np.int64)
+    label_magnitudes = [np.nan]
+    for value in np.unique(magnitudes[~np.isnan(magnitudes)]):
+        value_labels, count = ndimage.label(magnitudes == value)
+        inside = value_labels > 0
+        labels[inside] = value_labels[inside] + len(label_magnitudes) - 1
+        label_magnitudes += [value] * count
+    return labels, np.array(label_magnitudes)
+
+
+def boundary_edges(labels):
+    """Directed pixel-boundary edges, traced with their region on the right.
+
+    Returns (owner label, start vertex, end vertex, direction) arrays, where vertices
+    index the (rows + 1) x (cols + 1) lattice of pixel corners.
+    """
+    num_rows, num_cols = labels.shape
+    padded = np.pad(labels, 1)
+    center = padded[1:-1, 1:-1]
+    rows, cols = np.indices(labels.shape)
+
+    def vertex(r, c):
+        return r * (num_cols + 1) + c
+
+    owners, starts, ends, directions = [], [], [], []
+    neighbours = [
+        (padded[:-2, 1:-1], EAST, (rows, cols), (rows, cols + 1)),  # top side
+        (padded[1:-1, 2:], SOUTH, (rows, cols + 1), (rows + 1, cols + 1)),  # right side
+        (padded[2:, 1:-1], WEST, (rows + 1, cols + 1), (rows + 1, cols)),  # bottom side
+        (padded[1:-1, :-2], NORTH, (rows + 1, cols), (rows, cols)),  # left side
+    ]
+    for neighbour, direction, start, end in neighbours:
+        on_boundary = (center != 0) & (neighbour != center)
+        owners.append(center[on_boundary])
+        starts.append(vertex(*start)[on_boundary])
+        ends.append(vertex(*end)[on_boundary])
+        directions.append(np.full(on_boundary.sum(), direction))
+    return (np.concatenate(owners), np.concatenate(starts),
+            np.concatenate(ends), np.concatenate(directions))
+
+
+def link_edges(owners, starts, ends, directions, num_vertices):
+    # Successor of every edge: the edge of the same region leaving its end vertex.
+    # Where a region touches itself diagonally there are two candidates; turning left
+    # splits the boundary there into an exterior and a hole touching at one point,
+    # rather than a single self-touching ring, which is not a valid polygon
+    start_keys = owners * num_vertices + starts
+    order = np.argsort(start_keys, kind="stable")
+    sorted_keys = start_keys[order]
+    end_keys = owners * num_vertices + ends
+    first = np.searchsorted(sorted_keys, end_keys, side="left")
+    count = np.searchsorted(sorted_keys, end_keys, side="right") - first
+
+    successor = order[first]
+    saddle = np.nonzero(count == 2)[0]
+    other = order[first[saddle] + 1]
+    use_other = directions[other] == (directions[saddle] + 3) % 4
+    successor[saddle[use_other]] = other[use_other]
+    return successor
+
+
+def junctions(labels):
+    """Lattice vertices where boundaries meet: three or more regions (the outside counting
+    as one), or a region touching itself diagonally. Flat over the (rows + 1) x (cols + 1)
+    lattice of pixel corners.
+    """
+    padded = np.pad(labels, 1)
+    nw, ne, sw, se = padded[:-1, :-1], padded[:-1, 1:], padded[1:, :-1], padded[1:, 1:]
+    distinct = 1 + (ne != nw) + ((sw != nw) & (sw != ne)) + ((se != nw) & (se != ne) & (se != sw))
+    saddle = (nw == se) & (ne == sw) & (nw != ne)
+    return ((distinct >= 3) | saddle).ravel()
+
+
+def trace_rings(labels, keep=None):
+    """Trace every region boundary into closed rings of lattice vertices.
+
+    Returns a list of (label, ring) pairs; each ring is an (n, 2) array of (row, col)
+    corners with collinear vertices removed, except those flagged in keep (flat over
+    the vertex lattice, e.g. from junctions).
+    """
+    owners, starts, ends, directions = boundary_edges(labels)
+    num_cols = labels.shape[1] + 1
+    keep = None if keep is None else keep.tolist()
+    successor = link_edges(owners, starts, ends, directions, (labels.shape[0] + 1) * num_cols).tolist()
+    directions = directions.tolist()
+    starts = starts.tolist()
+
+    visited = bytearray(len(successor))
+    rings = []
+    for first in range(len(successor)):
+        if visited[first]:
+            continue
+        corners = []
+        edge = first
+        previous_direction = None
+        while not visited[edge]:
+            visited[edge] = 1
+            # Only corners where the boundary turns are kept
+            if directions[edge] != previous_direction or keep is not None and keep[starts[edge]]:
+                corners.append(starts[edge])
+            previous_direction = directions[edge]
+            edge = successor[edge]
+        if directions[first] == previous_direction and len(corners) > 1 and not (
+                keep is not None and keep[starts[first]]):
+            corners.pop(0)
+        corners = np.array(corners)
+        rings.append((int(owners[first]), np.column_stack([corners // num_cols, corners % num_cols])))
+    return rings
+
+
+def signed_area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+
+
+def douglas_peucker(points, tolerance):
+    """Douglas-Peucker over an (n, 2) polyline with both ends kept; returns the keep mask.
+
+    A closed polyline (last point equal to the first) is split at its farthest point first.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        segment = points[j] - points[i]
+        offsets = points[i + 1:j] - points[i]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(*offsets.T)
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        k = int(np.argmax(distances))
+        if distances[k] > tolerance or length == 0:
+            keep[i + 1 + k] = True
+            stack += [(i, i + 1 + k), (i + 1 + k, j)]
+    return keep
+
+
+def split_arcs(rings, keep, num_vertex_cols):
+    """Cut rings into boundary arcs between junction vertices.
+
+    Both regions along a boundary trace it, in opposite directions; each arc is keyed by
+    its vertex ids in a canonical direction, so the two traces map to one arc. Returns
+    ({key: closed}, [[(key, reversed), ...] per ring]).
+    """
+    arcs, ring_arcs = {}, []
+    for _, ring in rings:
+        ids = (ring[:, 0] * num_vertex_cols + ring[:, 1]).tolist()
+        nodes = [i for i, vertex in enumerate(ids) if keep[vertex]]
+        if not nodes:
+            # A boundary without junctions: a closed arc from its lowest vertex, lowest neighbour next
+            first = ids.index(min(ids))
+            ids = ids[first:] + ids[:first]
+            reverse = len(ids) > 2 and ids[1] > ids[-1]
+            key = tuple([ids[0]] + ids[:0:-1]) if reverse else tuple(ids)
+            arcs[key] = True
+            ring_arcs.append([(key, reverse)])
+            continue
+        ids = ids[nodes[0]:] + ids[:nodes[0]] + [ids[nodes[0]]]
+        cuts = [i - nodes[0] for i in nodes] + [len(ids) - 1]
+        parts = []
+        for a, b in zip(cuts[:-1], cuts[1:]):
+            arc = ids[a:b + 1]
+            reverse = arc[0] > arc[-1] or arc[0] == arc[-1] and len(arc) > 2 and arc[1] > arc[-2]
+            key = tuple(arc[::-1]) if reverse else tuple(arc)
+            arcs[key] = False
+            parts.append((key, reverse))
+        ring_arcs.append(parts)
+    return arcs, ring_arcs
+
+
+def simplify_arcs(arcs, tolerance, lattice_shape):
+    """Douglas-Peucker keep masks per arc, refined until the topology is unchanged.
+
+    A simplified segment may not cross or touch another one, nor leave a vertex of another
+    boundary on its wrong side. Each stretch that does gets back its farthest original
+    vertex and the check is repeated, so the polygons stay valid and neighbours keep
+    sharing their edges.
+    """
+    keys = list(arcs)
+    # All arcs in flat arrays; closed arcs repeat their first vertex at the end
+    paths = [np.array(key + key[:1] if arcs[key] else key) for key in keys]
+    lengths = np.array([len(path) for path in paths])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    ids = np.concatenate(paths)
+    xy = _vertex_xy(ids, lattice_shape[1])
+    owners = np.repeat(np.arange(len(keys)), lengths)
+    keep = np.zeros(len(ids), dtype=bool)
+    for index, key in enumerate(keys):
+        arc_keep = douglas_peucker(xy[offsets[index]:offsets[index + 1]], tolerance)
+        # Tiny rings are left alone, and a ring never drops below a triangle
+        if arcs[key] and (len(key) <= 4 or arc_keep.sum() < 4):
+            arc_keep[:] = True
+        keep[offsets[index]:offsets[index + 1]] = arc_keep
+
+    while True:
+        refined = False
+        for a, b in _topology_errors(ids, xy, keep, owners, lattice_shape):
+            if b - a < 2:
+                continue
+            chord = xy[b] - xy[a]
+            stretch = xy[a + 1:b] - xy[a]
+            distances = np.abs(chord[0] * stretch[:, 1] - chord[1] * stretch[:, 0])
+            keep[a + 1 + int(np.argmax(distances))] = True
+            refined = True
+        if not refined:
+            break
+    return {key: keep[offsets[index]:offsets[index + 1] - (1 if arcs[key] else 0)] for index, key in enumerate(keys)}
+
+
+def _topology_errors(ids, xy, keep, owners, lattice_shape, cell_size=4):
+    # (a, b) flat indices of the simplified segments xy[a] -> xy[b] that cross, touch or
+    # overlap another segment, or sweep over a vertex of another boundary
+    kept = np.flatnonzero(keep)
+    same_arc = owners[kept[:-1]] == owners[kept[1:]]
+    firsts, lasts = kept[:-1][same_arc], kept[1:][same_arc]
+    starts, ends = ids[firsts], ids[lasts]
+    p, q = xy[firsts], xy[lasts]
+    low, high = np.minimum(p, q), np.maximum(p, q)
+
+    # Candidate segment pairs: those sharing a cell of a coarse grid over the lattice
+    cell_low, cell_high = low // cell_size, high // cell_size
+    widths = cell_high - cell_low + 1
+    segment, offset = _expand(widths[:, 0] * widths[:, 1])
+    cells = ((cell_low[segment, 1] + offset // widths[segment, 0]) * (lattice_shape[1] // cell_size + 1)
+             + cell_low[segment, 0] + offset % widths[segment, 0])
+    order = np.lexsort([segment, cells])
+    cells, segment = cells[order], segment[order]
+    group_end = np.searchsorted(cells, cells, side="right")
+    first, partner = _expand(group_end - np.arange(len(cells)) - 1)
+    # A pair sharing several cells is tested more than once, which is cheaper than deduplicating
+    i, j = segment[first], segment[first + 1 + partner]
+    overlap = np.all((low[i] <= high[j]) & (low[j] <= high[i]), axis=1)
+    i, j = i[overlap], j[overlap]
+    hit = _segments_meet(p[i], q[i], p[j], q[j], starts[i], ends[i], starts[j], ends[j])
+    bad = np.zeros(len(firsts), dtype=bool)
+    bad[i[hit]] = bad[j[hit]] = True
+
+    # Vertices of other boundaries inside the area between an original stretch of an arc
+    # and the segment that replaces it: the lattice points of each stretch's bounding box
+    # that are current vertices, tested against the stretch closed by its segment
+    present = np.zeros(lattice_shape, dtype=bool)
+    present.ravel()[ids[kept]] = True
+    swept = np.flatnonzero((lasts - firsts > 1) & ~bad)
+    bounds = np.column_stack([firsts[swept], lasts[swept] + 1]).ravel()
+    padded = np.vstack([xy, xy[-1:]])
+    box_low = np.minimum.reduceat(padded, bounds)[::2]
+    box_size = np.maximum.reduceat(padded, bounds)[::2] + 1 - box_low
+    stretch, offset = _expand(box_size[:, 0] * box_size[:, 1])
+    x = box_low[stretch, 0] + offset % box_size[stretch, 0]
+    y = box_low[stretch, 1] + offset // box_size[stretch, 0]
+    vertex = y * lattice_shape[1] + x
+    candidate = present[y, x] & (vertex != starts[swept[stretch]]) & (vertex != ends[swept[stretch]])
+    stretch, x, y = stretch[candidate], x[candidate], y[candidate]
+    # Even-odd rule over the edges of each stretch, the last edge being the segment back
+    edge_counts = lasts[swept[stretch]] - firsts[swept[stretch]] + 1
+    point, edge = _expand(edge_counts)
+    a = firsts[swept[stretch[point]]] + edge
+    b = np.where(edge == edge_counts[point] - 1, firsts[swept[stretch[point]]], a + 1)
+    x1, y1, x2, y2 = xy[a, 0], xy[a, 1], xy[b, 0], xy[b, 1]
+    px, py = x[point], y[point]
+    straddles = (y1 > py) != (y2 > py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossings = straddles & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+    inside = np.bincount(point, weights=crossings, minlength=len(stretch)) % 2 == 1
+    bad[swept[stretch[inside]]] = True
+    return [(int(firsts[segment]), int(lasts[segment])) for segment in np.flatnonzero(bad)]
+
+
+def _expand(counts):
+    # (run, offset within the run) for every item of consecutive runs of the given lengths
+    counts = np.asarray(counts, dtype=np.int64)
+    run = np.repeat(np.arange(len(counts)), counts)
+    return run, np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _vertex_xy(ids, num_vertex_cols):
+    # (x, y) = (col, row) of lattice vertex ids
+    return np.column_stack([ids % num_vertex_cols, ids // num_vertex_cols]).astype(np.int64)
+
+
+def _orientation(a, b, c):
+    return np.sign((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+
+
+def _on_segment(point, a, b):
+    # For a point collinear with a-b: whether it lies within the segment
+    return ((np.minimum(a[:, 0], b[:, 0]) <= point[:, 0]) & (point[:, 0] <= np.maximum(a[:, 0], b[:, 0]))
+            & (np.minimum(a[:, 1], b[:, 1]) <= point[:, 1]) & (point[:, 1] <= np.maximum(a[:, 1], b[:, 1])))
+
+
+def _segments_meet(p1, p2, q1, q2, p1_ids, p2_ids, q1_ids, q2_ids):
+    # Pairs of lattice segments that cross, touch or overlap anywhere but at a shared end
+    d1, d2 = _orientation(q1, q2, p1), _orientation(q1, q2, p2)
+    d3, d4 = _orientation(p1, p2, q1), _orientation(p1, p2, q2)
+    meet = (d1 * d2 < 0) & (d3 * d4 < 0)
+    meet |= (d1 == 0) & _on_segment(p1, q1, q2) & (p1_ids != q1_ids) & (p1_ids != q2_ids)
+    meet |= (d2 == 0) & _on_segment(p2, q1, q2) & (p2_ids != q1_ids) & (p2_ids != q2_ids)
+    meet |= (d3 == 0) & _on_segment(q1, p1, p2) & (q1_ids != p1_ids) & (q1_ids != p2_ids)
+    meet |= (d4 == 0) & _on_segment(q2, p1, p2) & (q2_ids != p1_ids) & (q2_ids != p2_ids)
+    # The same segment twice, e.g. two arcs between the same junctions both straightened
+    meet |= (np.minimum(p1_ids, p2_ids) == np.minimum(q1_ids, q2_ids)) & (
+        np.maximum(p1_ids, p2_ids) == np.maximum(q1_ids, q2_ids))
+    return meet
+
+
+def simplify_rings(rings, tolerance, keep, lattice_shape):
+    """Simplify traced rings arc by arc (see simplify_arcs); returns the (n, 2) (row, col)
+    rings in the same order.
+    """
+    if not rings:
+        return []
+    num_vertex_cols = lattice_shape[1]
+    arcs, ring_arcs = split_arcs(rings, keep, num_vertex_cols)
+    keeps = simplify_arcs(arcs, tolerance, lattice_shape)
+    simplified = []
+    for parts in ring_arcs:
+        ids = []
+        for key, reverse in parts:
+            arc = np.array(key)[keeps[key]]
+            if not arcs[key]:
+                # The last vertex of every arc is the first of the next one
+                arc = arc[:-1] if not reverse else arc[:0:-1]
+            elif reverse:
+                arc = arc[::-1]
+            ids.append(arc)
+        ids = np.concatenate(ids)
+        simplified.append(np.column_stack([ids // num_vertex_cols, ids % num_vertex_cols]))
+    return simplified
+
+
+def polygonize(magnitudes, latitudes, longitudes, tolerance=0.0):
+    """Merge contiguous pixels of equal magnitude into polygons.
+
+    Pixel centres sit at the given latitudes (rows) and longitudes (cols), so polygon
+    edges fall half a pixel outside them. tolerance is the Douglas-Peucker simplification
+    tolerance in pixels (0 keeps the exact pixel outlines). Simplification works on the
+    boundary arcs between junctions, each simplified once for both regions along it, and
+    keeps whatever vertices it takes not to cross or swallow another boundary, so the
+    polygons stay valid and tile the field without gaps or overlaps.
+
+    Returns {magnitude: [polygon, ...]}, each polygon a list of (n, 2) lon/lat rings with
+    the exterior first, wound as GeoJSON expects (exterior counterclockwise).
+    """
+    labels, label_magnitudes = label_regions(np.asarray(magnitudes, dtype=np.float64))
+    lat_step = (latitudes[-1] - latitudes[0]) / max(len(latitudes) - 1, 1)
+    lon_step = (longitudes[-1] - longitudes[0]) / max(len(longitudes) - 1, 1)
+    # Pixel rows grow downwards, so a positive area in (col, row) is an exterior ring
+    # and the winding flips whenever one of the axes runs backwards in lon/lat
+    flip = lat_step * lon_step < 0
+
+    polygons_by_label = {}
+    if tolerance > 0:
+        keep = junctions(labels)
+        rings = trace_rings(labels, keep)
+        simplified = simplify_rings(rings, tolerance, keep, (labels.shape[0] + 1, labels.shape[1] + 1))
+    else:
+        rings = trace_rings(labels)
+        simplified = [ring for _, ring in rings]
+    for (label, ring), kept in zip(rings, simplified):
+        exterior = signed_area(ring[:, ::-1]) > 0
+        xy = kept[:, ::-1]
+        coordinates = np.column_stack([
+            longitudes[0] + (xy[:, 0] - 0.5) * lon_step,
+            latitudes[0] + (xy[:, 1] - 0.5) * lat_step,
+        ])
+        if flip:
+            coordinates = coordinates[::-1]
+        rings = polygons_by_label.setdefault(label, [])
+        if exterior:
+            rings.insert(0, coordinates)
+        else:
+            rings.append(coordinates)
+
+    polygons = {}
+    for label, rings in sorted(polygons_by_label.items()):
+        polygons.setdefault(float(label_magnitudes[label]), []).append(rings)
+    return polygons
+
+
+def save_polygon_geojson(magnitudes, latitudes, longitudes, output_file, tolerance=0.0, precision=6):
+    """Write one MultiPolygon feature per magnitude to a GeoJSON FeatureCollection."""
+    polygons = polygonize(magnitudes, latitudes, longitudes, tolerance)
+    point_format = f"[%.{precision}f,%.{precision}f]"
+    with GeoJSONWriter(output_file, precision=precision) as writer:
+        for magnitude, magnitude_polygons in polygons.items():
+            multipolygon = ",".join(
+                "[" + ",".join(_ring_json(ring, point_format) for ring in rings) + "]"
+                for rings in magnitude_polygons
+            )
+            writer.write_raw_features([
+                '{"type":"Feature","geometry":{"type":"MultiPolygon","coordinates":[%s]},'
+                '"properties":{"magnitude":%s}}' % (multipolygon, _format_magnitude(magnitude))
+            ])
+
+
+def _ring_json(ring, point_format):
+    # GeoJSON rings repeat their first position at the end
+    closed = np.vstack([ring, ring[:1]])
+    return "[" + ",".join([point_format] * len(closed)) % tuple(closed.ravel().tolist()) + "]"
+
+
+def _format_magnitude(magnitude):
+    return "%d" % magnitude if float(magnitude).is_integer() else repr(float(magnitude))
@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from radar_store import NODATA, from_epoch, open_store, to_epoch
+
+
+class RainQuery:
+    """Point and time-window queries over the radar store.
+
+    The grid axes are linear, so a lat/lon maps to its pixel with one multiply and round.
+    The most recent `hot_hours` of frames are kept in memory and answer most queries
+    without touching the file; older windows are read from the store block by block.
+    The store is opened only while reading and the window is reloaded when the file
+    changes, so frames added by a running tail show up in the next query.
+
+    Usage:
+        rain = RainQuery("outputs/rainfall_magnitudes.h5")
+        rain.query([1.35], [103.82], hours=2)
+    """
+
+    def __init__(self, store_path="outputs/rainfall_magnitudes.h5", hot_hours=6, open_timeout=5.0):
+        self.store_path = store_path
+        self.hot_hours = hot_hours
+        self.open_timeout = open_timeout
+        self.lock = threading.Lock()
+        self.mtime = None
+        self._clear()
+        self.refresh()
+
+    def open(self):
+        """Open the store for reading, waiting while a writer holds the file lock.
+
+        The store is only held open for a refresh or a cold read, so writers (tail,
+        backfill, accumulations) can commit between queries.
+        """
+        deadline = time.monotonic() + self.open_timeout
+        while True:
+            try:
+                return open_store(self.store_path, mode="r")
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def refresh(self):
+        """Bring the grid and the in-memory window up to date if the store file changed.
+
+        A missing store (not created yet, or being replaced) reads as an empty one.
+        """
+        try:
+            mtime = os.stat(self.store_path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            with self.open() as store:
+                self._load(store)
+        except FileNotFoundError:
+            self._clear()
+            mtime = None
+        self.mtime = mtime
+
+    def _clear(self):
+        self.num_frames = 0
+        self.latitudes = self.longitudes = None
+        self.hot_frames = np.zeros((0, 0, 0), dtype=np.uint8)
+        self.hot_epochs = np.zeros(0, dtype=np.int64)
+        self.latest = None
+
+    def _load(self, store):
+        # Frames appended since the last load are read on their own and frames that fell out
+        # of the window dropped; anything else (frames stored into the window, another grid)
+        # reloads the window from scratch
+        epochs = to_epoch(store.times())
+        if not len(epochs):
+            self._clear()
+            return
+        latitudes, longitudes = store.latitudes, store.longitudes
+        window = epochs[epochs >= epochs[-1] - int(self.hot_hours * 3600)]
+        keep = self.hot_epochs >= window[0]
+        held = self.hot_epochs[keep]
+        if not (self.latitudes is not None and np.array_equal(latitudes, self.latitudes)
+                and np.array_equal(longitudes, self.longitudes) and np.array_equal(window[:len(held)], held)):
+            keep = np.zeros(len(self.hot_epochs), dtype=bool)
+            held = self.hot_epochs[keep]
+        frames = [self.hot_frames[keep]] if len(held) else []
+        if len(held) < len(window):
+            new_frames, _, _, _ = store.read(from_epoch(window[len(held)]), from_epoch(window[-1]), raw=True)
+            frames.append(new_frames)
+        self.hot_frames = np.concatenate(frames)
+        self.hot_epochs = window
+        self.num_frames = len(epochs)
+        self.latitudes, self.longitudes = latitudes, longitudes
+        self.lat_step = (latitudes[-1] - latitudes[0]) / max(len(latitudes) - 1, 1)
+        self.lon_step = (longitudes[-1] - longitudes[0]) / max(len(longitudes) - 1, 1)
+        self.latest = from_epoch(epochs[-1])
+
+    def pixel_index(self, latitudes, longitudes):
+        """Grid (rows, cols) nearest to each lat/lon, and whether the point is on the grid."""
+        rows = np.rint((np.asarray(latitudes, dtype=np.float64) - self.latitudes[0]) / self.lat_step).astype(np.int64)
+        cols = np.rint((np.asarray(longitudes, dtype=np.float64) - self.longitudes[0]) / self.lon_step).astype(np.int64)
+        inside = (rows >= 0) & (rows < len(self.latitudes)) & (cols >= 0) & (cols < len(self.longitudes))
+        return np.where(inside, rows, 0), np.where(inside, cols, 0), inside
+
+    def values(self, latitudes, longitudes, start=None, end=None):
+        """Raw magnitudes (time, points) at the given points over a time window.
+
+        Returns (values, times, inside); points off the grid read as NODATA.
+        """
+        empty = (np.zeros((0, len(latitudes)), dtype=np.uint8), from_epoch(np.zeros(0, dtype=np.int64)),
+                 np.zeros(len(latitudes), dtype=bool))
+        if not self.num_frames:
+            # Nothing stored yet, not even the grid
+            return empty
+        rows, cols, inside = self.pixel_index(latitudes, longitudes)
+        start_epoch = None if start is None else to_epoch(start)[0]
+        end_epoch = None if end is None else to_epoch(end)[0]
+        if len(self.hot_epochs) and (start_epoch is None and self.num_frames == len(self.hot_epochs)
+                                     or start_epoch is not None and start_epoch >= self.hot_epochs[0]):
+            lo = 0 if start_epoch is None else np.searchsorted(self.hot_epochs, start_epoch, side="left")
+            hi = len(self.hot_epochs) if end_epoch is None else np.searchsorted(self.hot_epochs, end_epoch, side="right")
+            values = self.hot_frames[lo:hi][:, rows, cols]
+            times = from_epoch(self.hot_epochs[lo:hi])
+        else:
+            try:
+                with self.open() as store:
+                    values, times = store.read_points(rows, cols, start, end)
+            except FileNotFoundError:
+                # Removed since the refresh
+                return empty
+        values[:, ~inside] = NODATA
+        return values, times, inside
+
+    def query(self, latitudes, longitudes, start=None, end=None, hours=None):
+        """JSON-ready rain summary at each point for a time window.
+
+        Without start, `hours` before the end (default the latest frame) is used. An empty
+        store answers with no times.
+        """
+        with self.lock:
+            self.refresh()
+            if hours is not None and start is None and (end or self.latest) is not None:
+                end = end or self.latest
+                start = np.datetime64(end, "s") - np.timedelta64(int(hours * 3600), "s")
+            values, times, inside = self.values(latitudes, longitudes, start, end)
+
+        raining = values != NODATA
+        rain_frames = raining.sum(axis=0)
+        points = []
+        for i, (lat, lon) in enumerate(zip(latitudes, longitudes)):
+            column = values[:, i]
+            rain = column[raining[:, i]]
+            points.append({
+                "lat": float(lat), "lon": float(lon), "inside": bool(inside[i]),
+                "magnitudes": [int(v) if v != NODATA else None for v in column.tolist()],
+                "rain_frames": int(rain_frames[i]),
+                "max": int(rain.max()) if len(rain) else None,
+                "mean": round(float(rain.mean()), 3) if len(rain) else None,
+            })
+        return {"times": [str(t) for t in times], "points": points}
+
+
+class RainQueryHandler(BaseHTTPRequestHandler):
+    """GET /rain?lat=..&lon=..[&lat=..&lon=..][&start=..][&end=..][&hours=..]
+    POST /rain with {"points": [[lat, lon], ...], "start": .., "end": .., "hours": ..}
+    """
+
+    rain_query = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            points = list(zip(map(float, params.get("lat", [])), map(float, params.get("lon", []))))
+            self._answer(url.path, points, params.get("start", [None])[0], params.get("end", [None])[0],
+                         params.get("hours", [None])[0])
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+        except BlockingIOError as e:
+            self._send(503, {"error": str(e)})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            points = [(float(lat), float(lon)) for lat, lon in body.get("points", [])]
+            self._answer(urlparse(self.path).path, points, body.get("start"), body.get("end"), body.get("hours"))
+        except (ValueError, TypeError) as e:
+            self._send(400, {"error": str(e)})
+        except BlockingIOError as e:
+            self._send(503, {"error": str(e)})
+
+    def _answer(self, path, points, start, end, hours):
+        if path != "/rain":
+            self._send(404, {"error": f"unknown path {path}"})
+            return
+        if not points:
+            raise ValueError("at least one lat/lon point is required")
+        latitudes, longitudes = zip(*points)
+        self._send(200, self.rain_query.query(latitudes, longitudes, start, end,
+                                              None if hours is None else float(hours)))
+
+    def _send(self, status, payload):
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Per-request logging to stderr costs more than answering the query
+        pass
+
+
+def serve(store_path="outputs/rainfall_magnitudes.h5", host="127.0.0.1", port=8765, hot_hours=6):
+    RainQueryHandler.rain_query = RainQuery(store_path, hot_hours)
+    server = ThreadingHTTPServer((host, port), RainQueryHandler)
+    print(f"Serving rain queries for {store_path} on http://{host}:{port}/rain")
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve point and time-window rain queries over the radar store")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--hot-hours", type=float, default=6, help="recent hours of frames kept in memory")
+    args = parser.parse_args()
+    serve(args.store, args.host, args.port, args.hot_hours)
+
+
+if __name__ == "__main__":
+    main()
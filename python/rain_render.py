@@ -0,0 +1,35 @@
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import BoundaryNorm
+from matplotlib.figure import Figure
+from PIL import Image
+
+
+class FrameRenderer:
+    """Render magnitude frames to images with one reusable Agg figure.
+
+    The figure is built once, without pyplot, so nothing is shown or kept in global
+    state and it works headless. Each frame only swaps the image data and the title.
+    Magnitude n is always drawn in colour n of the colormap, so frames of a time-lapse
+    are comparable (a per-frame autoscale would shift the colours with the maximum).
+    """
+
+    def __init__(self, cmap, frame_shape, extent=None, figsize=(10, 8), dpi=100, label='Rain Magnitude'):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot()
+        norm = BoundaryNorm(np.arange(cmap.N + 1) + 0.5, cmap.N)
+        self.image = ax.imshow(np.full(frame_shape, np.nan), cmap=cmap, norm=norm, aspect='auto', extent=extent,
+                               interpolation='nearest')
+        self.figure.colorbar(self.image, ax=ax, label=label)
+        self.title = ax.set_title('')
+
+    def render(self, magnitude, title=''):
+        """Draw one frame and return it as an (height, width, 4) uint8 RGBA array."""
+        self.image.set_data(magnitude)
+        self.title.set_text(title)
+        self.canvas.draw()
+        return np.asarray(self.canvas.buffer_rgba())
+
+    def save(self, magnitude, output_file, title=''):
+        Image.fromarray(self.render(magnitude, title)).convert('RGB').save(output_file)
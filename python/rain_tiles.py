@@ -0,0 +1,198 @@
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+from convert_color_array import RainfallAnalyzer
+from radar_store import NODATA, encode_magnitudes, open_store
+
+TILE_SIZE = 256
+
+
+def lon_to_x(lon, zoom):
+    """Web Mercator global pixel x of a longitude at a zoom level."""
+    return (np.asarray(lon) + 180.0) / 360.0 * (TILE_SIZE << zoom)
+
+
+def lat_to_y(lat, zoom):
+    """Web Mercator global pixel y of a latitude (0 at the top of the world)."""
+    return (1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * (TILE_SIZE << zoom)
+
+
+def x_to_lon(x, zoom):
+    return np.asarray(x) / (TILE_SIZE << zoom) * 360.0 - 180.0
+
+
+def y_to_lat(y, zoom):
+    return np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(y) / (TILE_SIZE << zoom)))))
+
+
+def source_indices(axis, coordinates):
+    # Nearest grid index of each coordinate on a linear axis, -1 outside the grid
+    step = (axis[-1] - axis[0]) / max(len(axis) - 1, 1)
+    position = np.rint((coordinates - axis[0]) / step)
+    return np.where((position >= 0) & (position < len(axis)), position, -1).astype(np.int64)
+
+
+class TileLevel:
+    """Web Mercator resampling of the radar grid at one zoom level.
+
+    Latitude only depends on the Mercator y and longitude only on x, so the
+    nearest-neighbour resampling is separable: one source row per output pixel row and
+    one source column per output pixel column.
+    """
+
+    def __init__(self, zoom, latitudes, longitudes):
+        self.zoom = zoom
+        x0, x1 = np.sort(lon_to_x([longitudes[0], longitudes[-1]], zoom))
+        y0, y1 = np.sort(lat_to_y([latitudes[0], latitudes[-1]], zoom))
+        self.tile_x0, self.tile_x1 = int(x0 // TILE_SIZE), int(x1 // TILE_SIZE) + 1
+        self.tile_y0, self.tile_y1 = int(y0 // TILE_SIZE), int(y1 // TILE_SIZE) + 1
+        # Pixel centres of every output pixel column/row over the covered tiles
+        xs = np.arange(self.tile_x0 * TILE_SIZE, self.tile_x1 * TILE_SIZE) + 0.5
+        ys = np.arange(self.tile_y0 * TILE_SIZE, self.tile_y1 * TILE_SIZE) + 0.5
+        self.cols = source_indices(longitudes, x_to_lon(xs, zoom))
+        self.rows = source_indices(latitudes, y_to_lat(ys, zoom))
+
+    def tiles(self):
+        for tx in range(self.tile_x0, self.tile_x1):
+            for ty in range(self.tile_y0, self.tile_y1):
+                yield tx, ty
+
+    def source_window(self, tx, ty):
+        """Source (row_start, row_end, col_start, col_end) read by a tile, or None."""
+        rows = self._tile_axis(self.rows, ty - self.tile_y0)
+        cols = self._tile_axis(self.cols, tx - self.tile_x0)
+        if rows is None or cols is None:
+            return None
+        return rows[0], rows[1], cols[0], cols[1]
+
+    def render(self, palette_frame, tx, ty):
+        """Palette indices (TILE_SIZE, TILE_SIZE) of one tile, NODATA outside the grid."""
+        rows = self.rows[(ty - self.tile_y0) * TILE_SIZE:(ty - self.tile_y0 + 1) * TILE_SIZE]
+        cols = self.cols[(tx - self.tile_x0) * TILE_SIZE:(tx - self.tile_x0 + 1) * TILE_SIZE]
+        tile = palette_frame[np.maximum(rows, 0)[:, None], np.maximum(cols, 0)[None, :]]
+        tile[(rows < 0)[:, None] | (cols < 0)[None, :]] = NODATA
+        return tile
+
+    @staticmethod
+    def _tile_axis(indices, tile):
+        inside = indices[tile * TILE_SIZE:(tile + 1) * TILE_SIZE]
+        inside = inside[inside >= 0]
+        if len(inside) == 0:
+            return None
+        return int(inside.min()), int(inside.max()) + 1
+
+
+class TilePyramid:
+    """XYZ PNG tile pyramid of the latest magnitude frame, updated incrementally.
+
+    Tiles live in tile_dir/{z}/{x}/{y}.png as palette PNGs, magnitude n in colour n of
+    the colormap and no rain transparent. Tiles without rain are not written (a web map
+    treats a missing tile as empty). The frame the tiles show is kept in tile_dir, so an
+    update, in this process or a later one, only rewrites the tiles whose source pixels
+    changed.
+
+    Usage:
+        pyramid = TilePyramid(analyzer.cmap, latitudes, longitudes)
+        pyramid.update(magnitude)
+    """
+
+    def __init__(self, cmap, latitudes, longitudes, tile_dir="outputs/tiles", min_zoom=8, max_zoom=12):
+        self.tile_dir = tile_dir
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.zooms = np.array([min_zoom, max_zoom])
+        self.levels = [TileLevel(zoom, self.latitudes, self.longitudes) for zoom in range(min_zoom, max_zoom + 1)]
+        colors = np.round(cmap(np.arange(cmap.N))[:, :3] * 255).astype(np.uint8)
+        # Palette index = stored magnitude, index NODATA is transparent
+        self.palette = np.vstack([np.zeros((1, 3), dtype=np.uint8), colors]).ravel().tolist()
+        self.state_file = os.path.join(tile_dir, "frame.npz")
+
+    def update(self, magnitude):
+        """Bring the tiles up to date with a new frame. Returns the number of tiles rewritten."""
+        frame = encode_magnitudes(magnitude)
+        previous = self._load_state()
+        if previous is None:
+            changed = np.ones(frame.shape, dtype=bool)
+        else:
+            changed = previous != frame
+        # Summed-area table, so "any changed pixel in this window" is four lookups per tile
+        counts = np.zeros((frame.shape[0] + 1, frame.shape[1] + 1), dtype=np.int64)
+        counts[1:, 1:] = changed.cumsum(axis=0).cumsum(axis=1)
+
+        written = 0
+        for level in self.levels:
+            for tx, ty in level.tiles():
+                window = level.source_window(tx, ty)
+                if window is None:
+                    continue
+                r0, r1, c0, c1 = window
+                if counts[r1, c1] - counts[r0, c1] - counts[r1, c0] + counts[r0, c0] == 0:
+                    continue
+                self._write_tile(level.zoom, tx, ty, level.render(frame, tx, ty))
+                written += 1
+        self._save_state(frame)
+        return written
+
+    def tile_path(self, zoom, tx, ty):
+        return os.path.join(self.tile_dir, str(zoom), str(tx), f"{ty}.png")
+
+    def _write_tile(self, zoom, tx, ty, tile):
+        path = self.tile_path(zoom, tx, ty)
+        if not (tile != NODATA).any():
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        image = Image.fromarray(tile, mode="P")
+        image.putpalette(self.palette)
+        tmp_path = path + ".tmp"
+        image.save(tmp_path, format="PNG", transparency=NODATA, optimize=False)
+        os.replace(tmp_path, path)
+
+    def _load_state(self):
+        if not os.path.exists(self.state_file):
+            return None
+        with np.load(self.state_file) as state:
+            # Tiles drawn from another grid, or missing at some zoom levels, cannot be updated
+            # pixel by pixel
+            if not ("zooms" in state.files and np.array_equal(state["zooms"], self.zooms)
+                    and np.array_equal(state["latitudes"], self.latitudes)
+                    and np.array_equal(state["longitudes"], self.longitudes)):
+                return None
+            return state["frame"]
+
+    def _save_state(self, frame):
+        os.makedirs(self.tile_dir, exist_ok=True)
+        tmp_path = self.state_file + ".tmp.npz"
+        np.savez_compressed(tmp_path, frame=frame, latitudes=self.latitudes, longitudes=self.longitudes,
+                            zooms=self.zooms)
+        os.replace(tmp_path, self.state_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update the XYZ rain tile pyramid from a stored frame")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--color-file", default="extracted_colors.json")
+    parser.add_argument("--time", help="frame time, e.g. 2024-05-27T14:00 (default: latest)")
+    parser.add_argument("--tile-dir", default="outputs/tiles")
+    parser.add_argument("--min-zoom", type=int, default=8)
+    parser.add_argument("--max-zoom", type=int, default=12)
+    args = parser.parse_args()
+
+    with open_store(args.store, mode="r") as store:
+        frame_time = args.time or store.times()[-1]
+        frames, _, latitudes, longitudes = store.read(frame_time, frame_time, raw=True)
+    if len(frames) == 0:
+        raise SystemExit(f"No frame stored at {frame_time}")
+
+    cmap = RainfallAnalyzer(args.color_file).cmap
+    pyramid = TilePyramid(cmap, latitudes, longitudes, args.tile_dir, args.min_zoom, args.max_zoom)
+    written = pyramid.update(frames[0])
+    print(f"Tiles for {frame_time} in {args.tile_dir}: {written} rewritten")
+
+
+if __name__ == "__main__":
+    main()
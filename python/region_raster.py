@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def load_regions(geojson_file, name_property="name"):
+    """Read a GeoJSON Feature or FeatureCollection into {name: geometry}."""
+    with open(geojson_file, "r") as file:
+        data = json.load(file)
+    features = data["features"] if data["type"] == "FeatureCollection" else [data]
+    regions = {}
+    for i, feature in enumerate(features):
+        name = (feature.get("properties") or {}).get(name_property) or feature.get("id") or str(i)
+        regions[name] = feature["geometry"]
+    return regions
+
+
+def rasterize_geometry(geometry, latitudes, longitudes):
+    """Boolean (rows, cols) mask of the grid cells whose centre lies inside a (Multi)Polygon.
+
+    The grid is given by its 1-D latitudes (rows) and longitudes (cols), in either order.
+    Holes follow the even-odd rule. Each row is filled with one scanline pass over the
+    polygon edges, so no per-cell point-in-polygon test is made.
+    """
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+    col_order = np.argsort(longitudes)
+    sorted_longitudes = longitudes[col_order]
+    mask = np.zeros((len(latitudes), len(longitudes)), dtype=bool)
+
+    for polygon in polygons:
+        x1, y1, x2, y2 = _ring_edges(polygon)
+        for row, lat in enumerate(latitudes):
+            # Half-open test so a vertex on the scanline is counted once
+            crossing = (y1 <= lat) != (y2 <= lat)
+            if not crossing.any():
+                continue
+            xs = x1[crossing] + (lat - y1[crossing]) * (x2[crossing] - x1[crossing]) / (y2[crossing] - y1[crossing])
+            xs.sort()
+            starts = np.searchsorted(sorted_longitudes, xs[0::2], side="left")
+            ends = np.searchsorted(sorted_longitudes, xs[1::2], side="left")
+            fill = np.zeros(len(longitudes) + 1, dtype=np.int64)
+            np.add.at(fill, starts, 1)
+            np.add.at(fill, ends, -1)
+            mask[row, col_order] |= np.cumsum(fill[:-1]) > 0
+    return mask
+
+
+def cached_mask(geometry, latitudes, longitudes, cache_dir="cache/regions"):
+    """rasterize_geometry, cached on disk by geometry and grid."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    key = hashlib.sha256()
+    key.update(json.dumps(geometry, sort_keys=True).encode())
+    key.update(latitudes.tobytes())
+    key.update(longitudes.tobytes())
+    path = os.path.join(cache_dir, key.hexdigest() + ".npy")
+    if os.path.exists(path):
+        return np.unpackbits(np.load(path), count=len(latitudes) * len(longitudes)).astype(bool).reshape(
+            len(latitudes), len(longitudes))
+
+    mask = rasterize_geometry(geometry, latitudes, longitudes)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.packbits(mask))
+    os.replace(tmp_path, path)
+    return mask
+
+
+def _ring_edges(polygon):
+    # Edge endpoints of all rings of one polygon, rings closed if they are not already
+    x1, y1, x2, y2 = [], [], [], []
+    for ring in polygon:
+        ring = np.asarray(ring, dtype=np.float64)[:, :2]
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        x1.append(ring[:-1, 0])
+        y1.append(ring[:-1, 1])
+        x2.append(ring[1:, 0])
+        y2.append(ring[1:, 1])
+    return np.concatenate(x1), np.concatenate(y1), np.concatenate(x2), np.concatenate(y2)
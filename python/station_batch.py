@@ -0,0 +1,156 @@
+import argparse
+from datetime import date, datetime, timedelta
+
+import h5py
+import numpy as np
+
+from http_cache import HttpCache
+from region_raster import cached_mask, load_regions
+from station_tps import ALPHAS, StationInterpolator, fill_grid, grid_points
+
+API_URL = "https://api.data.gov.sg/v1/environment/{variable}?date={date}"
+VARIABLES = ["rainfall", "air-temperature", "wind-speed"]
+# Readings are aligned to the 5-minute rainfall steps
+STEP_MINUTES = 5
+
+
+def load_day(variable, day, http_cache):
+    # Past days do not change, only today's readings need revalidating
+    max_age = 0 if day >= date.today() else None
+    return http_cache.get_json(API_URL.format(variable=variable, date=day.isoformat()), max_age=max_age)
+
+
+def readings_tensor(datasets):
+    """Align readings of several data.gov.sg feeds to one station list and time axis.
+
+    Readings are matched to stations by station ID and binned to STEP_MINUTES steps (the
+    last reading of a step wins). Returns (station_ids, station_locations, times, values)
+    with values (time, variables, stations), NaN where there is no reading.
+    """
+    locations = {}
+    for data in datasets:
+        for station in data["metadata"]["stations"]:
+            locations[station["id"]] = (station["location"]["latitude"], station["location"]["longitude"])
+    station_ids = sorted(locations)
+    station_index = {station_id: i for i, station_id in enumerate(station_ids)}
+
+    def step_of(timestamp):
+        # Local timestamps like 2024-05-27T14:05:00+08:00, kept as naive local time
+        stamp = datetime.fromisoformat(timestamp).replace(tzinfo=None)
+        return stamp.replace(second=0, microsecond=0) - timedelta(minutes=stamp.minute % STEP_MINUTES)
+
+    times = sorted({step_of(item["timestamp"]) for data in datasets for item in data["items"]})
+    time_index = {step: i for i, step in enumerate(times)}
+    values = np.full((len(times), len(datasets), len(station_ids)), np.nan)
+    for v, data in enumerate(datasets):
+        for item in data["items"]:
+            t = time_index[step_of(item["timestamp"])]
+            for reading in item["readings"]:
+                if reading["station_id"] in station_index and reading["value"] is not None:
+                    values[t, v, station_index[reading["station_id"]]] = reading["value"]
+    station_locations = np.array([locations[station_id] for station_id in station_ids])
+    return station_ids, station_locations, np.array(times, dtype="datetime64[s]"), values
+
+
+def grid_axes(station_locations, size=100, buffer=0.1):
+    """The TPS scripts' grid: size x size over the stations' bounding box plus a buffer."""
+    grid_lat = np.linspace(station_locations[:, 0].min() - buffer, station_locations[:, 0].max() + buffer, size)
+    grid_lon = np.linspace(station_locations[:, 1].min() - buffer, station_locations[:, 1].max() + buffer, size)
+    return grid_lat, grid_lon
+
+
+def save_fields(output_file, fields, times, variables, grid_lat, grid_lon, mask=None):
+    """Write (time, variables, lat, lon) fields as one chunked, compressed float32 dataset.
+
+    With a (lat, lon) mask, it is saved as well; cells outside it should be NaN.
+    """
+    with FieldWriter(output_file, variables, grid_lat, grid_lon, mask) as writer:
+        writer.append(fields, times)
+
+
+class FieldWriter:
+    """Write fields in the save_fields layout a batch of times at a time.
+
+    Usage:
+        with FieldWriter("outputs/fused_rainfall.h5", ["fused", "radar"], grid_lat, grid_lon) as writer:
+            writer.append(fields, times)    # (time, variables, lat, lon), repeatedly
+    """
+
+    def __init__(self, output_file, variables, grid_lat, grid_lon, mask=None):
+        self.file = h5py.File(output_file, "w")
+        shape = (0, len(variables), len(grid_lat), len(grid_lon))
+        self.fields = self.file.create_dataset("fields", shape=shape, maxshape=(None,) + shape[1:], dtype=np.float32,
+                                               chunks=(1, 1) + shape[2:], compression="gzip", compression_opts=4,
+                                               shuffle=True)
+        self.fields.attrs["variables"] = variables
+        self.times = self.file.create_dataset("times", shape=(0,), maxshape=(None,), dtype=np.int64)
+        self.times.attrs["units"] = "seconds since 1970-01-01T00:00:00 (local time)"
+        self.file.create_dataset("latitudes", data=grid_lat)
+        self.file.create_dataset("longitudes", data=grid_lon)
+        if mask is not None:
+            self.file.create_dataset("mask", data=mask)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def append(self, fields, times):
+        start = self.fields.shape[0]
+        self.fields.resize(start + len(fields), axis=0)
+        self.fields[start:] = np.asarray(fields, dtype=np.float32)
+        self.times.resize(start + len(times), axis=0)
+        self.times[start:] = np.asarray(times).astype(np.int64)
+
+
+def interpolate_day(day, variables=VARIABLES, grid_size=100, output_file=None, http_cache=None, alphas=None,
+                    boundary_file=None):
+    """Interpolate a day of readings of every variable onto one grid in a single batch.
+
+    With alphas, every timestamp and variable is smoothed with the alpha of alphas that
+    has the lowest leave-one-out error. With a boundary GeoJSON, only the grid cells
+    inside it are interpolated; the others are NaN.
+    """
+    http_cache = http_cache or HttpCache("cache")
+    datasets = [load_day(variable, day, http_cache) for variable in variables]
+    station_ids, station_locations, times, values = readings_tensor(datasets)
+    grid_lat, grid_lon = grid_axes(station_locations, grid_size)
+
+    mask = None
+    if boundary_file:
+        mask = np.any([cached_mask(geometry, grid_lat, grid_lon) for geometry in load_regions(boundary_file).values()],
+                      axis=0)
+    interpolator = StationInterpolator(station_locations, grid_points(grid_lat, grid_lon, mask), station_ids=station_ids)
+    estimated = interpolator.interpolate_batch(values, alphas=alphas)
+    if mask is None:
+        # Grid points run latitude-fastest; make it (time, variables, lat, lon)
+        fields = estimated.reshape(len(times), len(variables), len(grid_lon), len(grid_lat)).transpose(0, 1, 3, 2)
+    else:
+        fields = np.moveaxis(fill_grid(estimated.reshape(-1, estimated.shape[-1]).T, mask), -1, 0).reshape(
+            len(times), len(variables), len(grid_lat), len(grid_lon))
+
+    output_file = output_file or f"outputs/station_fields_{day:%Y%m%d}.h5"
+    save_fields(output_file, fields, times, variables, grid_lat, grid_lon, mask)
+    return output_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Interpolate a day of station readings onto a grid in one batch")
+    parser.add_argument("day", type=date.fromisoformat, help="e.g. 2024-05-27")
+    parser.add_argument("--variables", nargs="+", default=VARIABLES)
+    parser.add_argument("--grid-size", type=int, default=100)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--tune-alpha", action="store_true", help="pick the TPS smoothing per timestamp by leave-one-out")
+    parser.add_argument("--boundary", help="GeoJSON boundary, e.g. singapore_boundary.geojson: interpolate only inside it")
+    args = parser.parse_args()
+    output_file = interpolate_day(args.day, args.variables, args.grid_size, args.output,
+                                  alphas=ALPHAS if args.tune_alpha else None, boundary_file=args.boundary)
+    print("Interpolated fields saved:", output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import argparse
+import time
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+from http_cache import HttpCache
+from radar_store import from_epoch, to_epoch
+
+LATEST_URL = "https://api.data.gov.sg/v1/environment/{variable}"
+VARIABLES = ["rainfall", "air-temperature", "wind-speed"]
+
+
+class StationStore:
+    """Station readings of the data.gov.sg feeds, keyed by station ID and time.
+
+    Every feed response is parsed once: stations get a fixed column by ID (their
+    coordinates are kept alongside), and each timestamp becomes one row of float32
+    readings, NaN where a station did not report. Rows go straight to an append-only
+    HDF5 spill file and into an in-memory ring buffer holding the last `capacity` rows
+    of every variable, so recent windows are array slices and older ones a read of the
+    spill. Timestamps already stored are skipped, so feeding the same response twice is
+    harmless.
+
+    Spill layout:
+        station_ids, latitudes, longitudes   (stations,), in column order, append-only
+        <variable>/times    int64 epoch seconds (naive local time) of each row, unique
+        <variable>/values   float32 (rows, stations), NaN fill, rows in arrival order
+
+    Usage:
+        with StationStore("outputs/station_readings.h5") as store:
+            store.ingest("rainfall", data)
+            timestamp, station_ids, locations, values = store.latest("rainfall")
+            times, readings = store.window("air-temperature", "2024-05-27", "2024-05-27T23:59")
+    """
+
+    def __init__(self, path="outputs/station_readings.h5", mode="a", capacity=2880, compression_level=4):
+        self.path = path
+        self.capacity = capacity
+        self.compression_level = compression_level
+        self.file = h5py.File(path, mode)
+        self.station_ids = [station_id.decode() if isinstance(station_id, bytes) else station_id
+                            for station_id in self.file["station_ids"][:]] if "station_ids" in self.file else []
+        self.station_index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self.station_locations = (np.column_stack([self.file["latitudes"][:], self.file["longitudes"][:]])
+                                  if self.station_ids else np.zeros((0, 2)))
+        # Per variable: epochs of all spilled rows, their time order, and the ring of the latest rows
+        self.epochs, self.epoch_sets, self.order, self.rings = {}, {}, {}, {}
+        for variable in self.variables():
+            self._load_variable(variable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def variables(self):
+        return [name for name in self.file if isinstance(self.file[name], h5py.Group)]
+
+    def times(self, variable):
+        """All stored times of a variable in time order."""
+        return from_epoch(self.epochs[variable][self.order[variable]])
+
+    def ingest(self, variable, data):
+        """Add a feed response ({"metadata": {"stations"}, "items"}) of one variable.
+
+        Returns the number of new timestamps stored.
+        """
+        self._add_stations(data["metadata"]["stations"])
+        if variable not in self.epochs:
+            self._create_variable(variable)
+        seen = self.epoch_sets[variable]
+        items, epochs = [], []
+        for item in data["items"]:
+            epoch = int(to_epoch(_feed_time(item["timestamp"]))[0])
+            if epoch not in seen:
+                seen.add(epoch)
+                items.append(item)
+                epochs.append(epoch)
+        if not items:
+            return 0
+
+        # Readings of all new timestamps in flat arrays, then scattered to (row, station column) at once
+        readings = [reading for item in items for reading in item["readings"]]
+        rows = np.repeat(np.arange(len(items)), [len(item["readings"]) for item in items])
+        columns = np.array([self.station_index.get(reading["station_id"], -1) for reading in readings], dtype=np.intp)
+        values = np.array([np.nan if reading["value"] is None else reading["value"] for reading in readings],
+                          dtype=np.float32)
+        block = np.full((len(items), len(self.station_ids)), np.nan, dtype=np.float32)
+        known = columns >= 0
+        block[rows[known], columns[known]] = values[known]
+        self._append(variable, np.array(epochs, dtype=np.int64), block)
+        return len(items)
+
+    def window(self, variable, start=None, end=None):
+        """Readings with start <= time <= end, in time order.
+
+        Returns (times, values) with values (time, stations) in station_ids order, NaN
+        where there is no reading.
+        """
+        epochs, order = self.epochs[variable], self.order[variable]
+        sorted_epochs = epochs[order]
+        lo = 0 if start is None else np.searchsorted(sorted_epochs, to_epoch(start)[0], side="left")
+        hi = len(sorted_epochs) if end is None else np.searchsorted(sorted_epochs, to_epoch(end)[0], side="right")
+        rows = order[lo:hi]
+        values = np.full((len(rows), len(self.station_ids)), np.nan, dtype=np.float32)
+        # The ring holds the last rows of the spill, row i in slot i % capacity
+        ring_values = self.rings[variable]
+        cached = rows >= len(epochs) - min(len(epochs), self.capacity)
+        width = min(ring_values.shape[1], len(self.station_ids))
+        values[cached, :width] = ring_values[rows[cached] % self.capacity, :width]
+        if not cached.all():
+            spilled = np.sort(rows[~cached])
+            dataset = self.file[variable]["values"]
+            if spilled[-1] - spilled[0] < 2 * len(spilled):
+                # Mostly contiguous (rows arrive in time order): one slice read
+                block = dataset[spilled[0]:spilled[-1] + 1][spilled - spilled[0]]
+            else:
+                block = dataset[spilled.tolist()]
+            # Rows come back in storage order, put them back in time order
+            values[~cached, :block.shape[1]] = block[np.searchsorted(spilled, rows[~cached])]
+        return from_epoch(epochs[rows]), values
+
+    def latest(self, variable, time=None):
+        """Readings of the latest time (or of a given time) with the reporting stations.
+
+        time may also be a feed timestamp such as data["items"][0]["timestamp"]. Returns
+        (time, station_ids, station_locations, values) of the stations that have a
+        reading, aligned by station ID.
+        """
+        if time is None:
+            time = from_epoch(self.epochs[variable][self.order[variable][-1:]])[0]
+        elif isinstance(time, str):
+            time = _feed_time(time)
+        times, values = self.window(variable, time, time)
+        if len(times) == 0:
+            raise KeyError(f"No {variable} readings at {time}")
+        reported = np.nonzero(~np.isnan(values[0]))[0]
+        return (times[0], [self.station_ids[i] for i in reported], self.station_locations[reported],
+                values[0, reported].astype(np.float64))
+
+    def locations(self, station_ids):
+        """(latitude, longitude) of each station ID, (n, 2)."""
+        return self.station_locations[[self.station_index[station_id] for station_id in station_ids]]
+
+    def _add_stations(self, stations):
+        new = [station for station in stations if station["id"] not in self.station_index]
+        if not new:
+            return
+        ids = [station["id"] for station in new]
+        locations = np.array([(station["location"]["latitude"], station["location"]["longitude"]) for station in new])
+        if "station_ids" not in self.file:
+            self.file.create_dataset("station_ids", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            self.file.create_dataset("latitudes", shape=(0,), maxshape=(None,), dtype=np.float64)
+            self.file.create_dataset("longitudes", shape=(0,), maxshape=(None,), dtype=np.float64)
+        start = len(self.station_ids)
+        for name, data in (("station_ids", ids), ("latitudes", locations[:, 0]), ("longitudes", locations[:, 1])):
+            self.file[name].resize(start + len(new), axis=0)
+            self.file[name][start:] = data
+        for station_id in ids:
+            self.station_index[station_id] = len(self.station_ids)
+            self.station_ids.append(station_id)
+        self.station_locations = np.vstack([self.station_locations, locations])
+
+    def _create_variable(self, variable):
+        group = self.file.create_group(variable)
+        times_ds = group.create_dataset("times", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(4096,))
+        times_ds.attrs["units"] = "seconds since 1970-01-01T00:00:00 (local time)"
+        group.create_dataset("values", shape=(0, 0), maxshape=(None, None), dtype=np.float32, chunks=(1024, 64),
+                             fillvalue=np.nan, compression="gzip", compression_opts=self.compression_level)
+        self._load_variable(variable)
+
+    def _load_variable(self, variable):
+        group = self.file[variable]
+        self.epochs[variable] = group["times"][:]
+        self.epoch_sets[variable] = set(self.epochs[variable].tolist())
+        self.order[variable] = np.argsort(self.epochs[variable], kind="stable")
+        # Warm the ring with the tail of the spill
+        num_rows = len(self.epochs[variable])
+        ring_values = np.full((self.capacity, max(len(self.station_ids), 1)), np.nan, dtype=np.float32)
+        tail = range(max(num_rows - self.capacity, 0), num_rows)
+        if len(tail):
+            slots = np.arange(tail.start, tail.stop) % self.capacity
+            values = group["values"][tail.start:tail.stop]
+            ring_values[slots, :values.shape[1]] = values
+        self.rings[variable] = ring_values
+
+    def _append(self, variable, epochs, block):
+        group = self.file[variable]
+        start = len(self.epochs[variable])
+        # One resize and one write per response; the NaN fill covers stations added since older rows
+        values_ds = group["values"]
+        values_ds.resize((start + len(block), max(values_ds.shape[1], block.shape[1])))
+        values_ds[start:, :block.shape[1]] = block
+        group["times"].resize(start + len(epochs), axis=0)
+        group["times"][start:] = epochs
+        self.file.flush()
+
+        ring_values = self.rings[variable]
+        if ring_values.shape[1] < block.shape[1]:
+            # New stations: widen the ring, with room to spare
+            wider = np.full((self.capacity, 2 * block.shape[1]), np.nan, dtype=np.float32)
+            wider[:, :ring_values.shape[1]] = ring_values
+            ring_values = wider
+        # A batch longer than the ring only keeps its last rows
+        keep = slice(max(len(block) - self.capacity, 0), None)
+        slots = np.arange(start, start + len(block))[keep] % self.capacity
+        ring_values[slots] = np.nan
+        ring_values[slots, :block.shape[1]] = block[keep]
+        self.rings[variable] = ring_values
+
+        self.epochs[variable] = np.concatenate([self.epochs[variable], epochs])
+        self.order[variable] = np.argsort(self.epochs[variable], kind="stable")
+
+
+def _feed_time(timestamp):
+    # Local timestamps like 2024-05-27T14:05:00+08:00, kept as naive local time
+    return datetime.fromisoformat(timestamp).replace(tzinfo=None)
+
+
+def poll(store_path="outputs/station_readings.h5", variables=VARIABLES, interval=60, http_cache=None):
+    """Ingest the latest readings of every variable every interval seconds, until interrupted."""
+    http_cache = http_cache or HttpCache("cache")
+    with StationStore(store_path) as store:
+        while True:
+            for variable in variables:
+                try:
+                    added = store.ingest(variable, http_cache.get_json(LATEST_URL.format(variable=variable), max_age=0))
+                except Exception as e:
+                    print(f"{variable}: {e}")
+                    continue
+                if added:
+                    print(f"{variable}: {added} new timestamps, latest {store.times(variable)[-1]}")
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the data.gov.sg station readings in a station store")
+    parser.add_argument("--store", default="outputs/station_readings.h5")
+    parser.add_argument("--variables", nargs="+", default=VARIABLES)
+    parser.add_argument("--interval", type=int, default=60, help="seconds between polls")
+    args = parser.parse_args()
+    poll(args.store, args.variables, args.interval)
+
+
+if __name__ == "__main__":
+    main()
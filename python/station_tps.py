@@ -0,0 +1,362 @@
+import hashlib
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.linalg import lu_factor, lu_solve, solve_triangular
+from scipy.spatial.distance import cdist
+from tps import PolynomialFeatures
+
+# Smoothing parameters tried by the alpha selection: none, then 1e-8 .. 1e2 four per decade
+ALPHAS = np.concatenate([[0.0], np.logspace(-8, 2, 41)])
+
+
+def tps_kernel(points, control_points, order=2, enforce_tps_kernel=False):
+    """RBF values between points and control points, exactly as ThinPlateSpline computes them."""
+    dist = cdist(points, control_points).astype(points.dtype)
+    power = order * 2 - control_points.shape[-1]
+    if power <= 0 or enforce_tps_kernel:
+        power = 2
+    if power % 2:
+        return dist**power
+    dist[dist == 0] = 1
+    return dist**power * np.log(dist)
+
+
+def grid_points(grid_lat, grid_lon, mask=None):
+    """Grid points in the order the TPS scripts use: latitude varies fastest.
+
+    With a boolean (lat, lon) mask (see region_raster.cached_mask), only the points of
+    the cells inside it, still in that order.
+    """
+    points = np.array(np.meshgrid(grid_lat, grid_lon)).reshape(2, -1).T
+    if mask is not None:
+        points = points[np.asarray(mask).T.ravel()]
+    return points
+
+
+def fill_grid(values, mask, fill_value=np.nan):
+    """(lat, lon) grid from values at the grid_points(grid_lat, grid_lon, mask) cells, fill_value elsewhere.
+
+    values is (cells,) or (cells, v); the grid is (lat, lon) or (lat, lon, v).
+    """
+    values = np.asarray(values)
+    mask = np.asarray(mask)
+    grid = np.full(mask.T.shape + values.shape[1:], fill_value, dtype=np.result_type(values, fill_value))
+    # Cells run latitude-fastest, which is C order of the (lon, lat) transpose
+    grid[mask.T] = values
+    return grid.swapaxes(0, 1)
+
+
+def transform_grid(tps, grid_lat, grid_lon, out=None, memory_budget=256 * 1024 ** 2, dtype=np.float64,
+                   workers=None, mask=None):
+    """Evaluate a fitted ThinPlateSpline on a (lat, lon) grid in row blocks.
+
+    The grid x control-point kernel is never built whole: rows of the grid are evaluated
+    in blocks sized so that the kernels of all blocks in flight stay within
+    memory_budget bytes, on a pool of worker threads, and written straight into out. out
+    is a preallocated array, a path (a .npy memory map is created there) or None (a new
+    array). dtype=np.float32 halves the kernel memory; the polynomial part is always
+    evaluated in float64, as the coordinates are far from the origin. With a boolean
+    (lat, lon) mask only the cells inside it are evaluated, the others are NaN.
+
+    Returns out with shape (len(grid_lat), len(grid_lon)) for one value per control
+    point, or (len(grid_lat), len(grid_lon), v).
+    """
+    grid_lat = np.asarray(grid_lat, dtype=np.float64)
+    grid_lon = np.asarray(grid_lon, dtype=np.float64)
+    control_points = np.asarray(tps.control_points, dtype=np.float64)
+    num_controls = len(control_points)
+    kernel_weights = tps.parameters[:num_controls].astype(dtype)
+    polynomial_weights = tps.parameters[num_controls:]
+    features = PolynomialFeatures(tps.order - 1).fit(control_points)
+    # Distances do not change with the origin; centred coordinates keep float32 kernels accurate
+    center = control_points.mean(axis=0)
+    centred_controls = control_points - center
+    num_values = tps.parameters.shape[1]
+
+    shape = (len(grid_lat), len(grid_lon)) + ((num_values,) if num_values > 1 else ())
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    elif out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != shape[:2]:
+            raise ValueError(f"mask has shape {mask.shape}, expected {shape[:2]}")
+
+    workers = workers or os.cpu_count() or 1
+    # Per grid point: float64 distances plus about three kernel temporaries in dtype, for every block in flight
+    bytes_per_row = len(grid_lon) * num_controls * (8 + 3 * np.dtype(dtype).itemsize)
+    block_rows = max(1, min(len(grid_lat), memory_budget // (bytes_per_row * workers)))
+
+    def evaluate(row_start):
+        rows = grid_lat[row_start:row_start + block_rows]
+        points = np.column_stack([np.repeat(rows, len(grid_lon)), np.tile(grid_lon, len(rows))])
+        inside = np.ones(len(points), dtype=bool) if mask is None else mask[row_start:row_start + len(rows)].ravel()
+        points = points[inside]
+        kernel = tps_kernel((points - center).astype(dtype), centred_controls, tps.order, tps.enforce_tps_kernel)
+        values = np.full((len(inside),) + shape[2:], np.nan, dtype=dtype)
+        values[inside] = (kernel @ kernel_weights + features.transform(points) @ polynomial_weights).reshape(
+            (len(points),) + shape[2:])
+        out[row_start:row_start + len(rows)] = values.reshape((len(rows),) + shape[1:])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(evaluate, range(0, len(grid_lat), block_rows)):
+            pass
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+class SmoothingPath:
+    """ThinPlateSpline fits of one station network for any alpha, from one eigendecomposition.
+
+    With P = Q1 R the polynomial terms and Q2 an orthonormal basis of the weights allowed
+    by P^T w = 0, the spline weights are w = Q2 g with (Q2^T K Q2 + alpha I) g = Q2^T y.
+    Once Q2^T K Q2 = U diag(eigenvalues) U^T, the fit for any alpha is a diagonal scaling,
+    and so are the residuals y - f = alpha w and the diagonal of the hat matrix. Those
+    give exact leave-one-out errors, (y_i - f_i) / (1 - H_ii), and GCV for a whole grid
+    of alphas at O(n^2) each, after one O(n^3) decomposition.
+    """
+
+    def __init__(self, station_locations, order=2, enforce_tps_kernel=False):
+        locations = np.asarray(station_locations, dtype=np.float64)
+        polynomial = PolynomialFeatures(order - 1).fit(locations).transform(locations)
+        num_terms = polynomial.shape[1]
+        self.kernel = tps_kernel(locations, locations, order, enforce_tps_kernel)
+        q, r = np.linalg.qr(polynomial, mode="complete")
+        self.range_basis, self.r = q[:, :num_terms], r[:num_terms]
+        null_basis = q[:, num_terms:]
+        self.eigenvalues, eigenvectors = np.linalg.eigh(null_basis.T @ self.kernel @ null_basis)
+        self.basis = null_basis @ eigenvectors
+
+    def scores(self, values, alphas=ALPHAS, criterion="loo"):
+        """Mean squared leave-one-out ("loo") or GCV ("gcv") error of every alpha: (alphas, v)."""
+        values = np.asarray(values, dtype=np.float64).reshape(len(self.kernel), -1)
+        # Residuals and the diagonal of I - H, both divided by alpha so that alpha = 0 works too
+        inverse = 1.0 / (self.eigenvalues[:, None] + np.asarray(alphas, dtype=np.float64))
+        residuals = np.einsum("nm,ma,mv->anv", self.basis, inverse, self.basis.T @ values)
+        if criterion == "loo":
+            leverage = (self.basis**2) @ inverse
+            return np.mean((residuals / leverage.T[:, :, None]) ** 2, axis=1)
+        if criterion == "gcv":
+            return len(values) * np.sum(residuals**2, axis=1) / inverse.sum(axis=0)[:, None] ** 2
+        raise ValueError(f"Unknown criterion {criterion!r}, expected 'loo' or 'gcv'")
+
+    def best_alpha(self, values, alphas=ALPHAS, criterion="loo"):
+        """The alpha of alphas with the lowest error, for every value column: (v,)."""
+        alphas = np.asarray(alphas, dtype=np.float64)
+        return alphas[np.argmin(self.scores(values, alphas, criterion), axis=0)]
+
+    def parameters(self, values, alpha):
+        """Spline parameters (stations + polynomial terms, v), like ThinPlateSpline.parameters.
+
+        alpha is one value or one per value column.
+        """
+        values = np.asarray(values, dtype=np.float64).reshape(len(self.kernel), -1)
+        alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), (values.shape[1],))
+        weights = self.basis @ (self.basis.T @ values / (self.eigenvalues[:, None] + alpha))
+        # The rest of the readings lies in the span of P: P c = y - (K + alpha I) w
+        polynomial = solve_triangular(self.r, self.range_basis.T @ (values - self.kernel @ weights - alpha * weights))
+        return np.vstack([weights, polynomial])
+
+
+class StationInterpolator:
+    """Thin plate spline interpolation from a fixed station network onto a fixed grid.
+
+    Gives the same result as ThinPlateSpline(alpha, order).fit(stations, values)
+    .transform(grid), to rounding, but the station system is factorized once and the
+    whole fit + transform is folded into one (grid x stations) operator, so each new set
+    of readings costs a single matrix-vector product.
+
+    The grid kernel (grid x all stations) is computed once per station network and grid
+    and cached on disk, as is the operator of the full network. When some stations have
+    no reading, only the small station system is factorized again for the stations that
+    remain and the grid kernel is reused by selecting its columns; those operators are
+    only kept in memory (`max_operators`), so dropout combinations do not pile up on disk.
+
+    Usage:
+        interpolator = StationInterpolator(station_locations, grid_points(grid_lat, grid_lon), station_ids=ids)
+        estimated = interpolator.interpolate(values)                   # all stations
+        estimated = interpolator.interpolate(values, reporting_ids)    # only these stations reported
+        estimated, alpha = interpolator.interpolate_tuned(values)      # alpha picked by leave-one-out
+    """
+
+    max_factorizations = 256
+    max_operators = 8
+
+    def __init__(self, station_locations, grid_points, alpha=0.0, order=2, enforce_tps_kernel=False,
+                 station_ids=None, cache_dir="cache/tps"):
+        self.station_locations = np.asarray(station_locations, dtype=np.float64)
+        self.grid_points = np.asarray(grid_points, dtype=np.float64)
+        self.alpha = alpha
+        self.order = order
+        self.enforce_tps_kernel = enforce_tps_kernel
+        self.station_ids = list(station_ids) if station_ids is not None else list(range(len(self.station_locations)))
+        self.station_index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self.cache_dir = cache_dir
+        self.features = PolynomialFeatures(order - 1).fit(self.station_locations)
+        self.grid_kernel = self._cached("kernel", self._build_grid_kernel, self.station_locations,
+                                        self.grid_points)["kernel"]
+        # Station subset -> LU factorization / grid operator / smoothing path, most recently used last
+        self.factorizations = OrderedDict()
+        self.operators = OrderedDict()
+        self.smoothing_paths = OrderedDict()
+
+    def interpolate(self, values, station_ids=None):
+        """Interpolate readings onto the grid.
+
+        values is (stations,) or (stations, v), one row per station of station_ids (default:
+        every station, in network order). Returns (grid,) or (grid, v).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        return self.operator(self._subset(station_ids)) @ values
+
+    def interpolate_tuned(self, values, station_ids=None, alphas=ALPHAS, criterion="loo"):
+        """Interpolate readings with the alpha of alphas that has the lowest leave-one-out (or GCV) error.
+
+        Each column of values gets its own alpha. Returns (estimated, alpha): estimated as
+        from interpolate, alpha (v,).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        subset = self._subset(station_ids)
+        path = self.smoothing_path(subset)
+        flat = values.reshape(len(subset), -1)
+        alpha = path.best_alpha(flat, alphas, criterion)
+        estimated = self.grid_kernel[:, self._columns(subset)] @ path.parameters(flat, alpha)
+        return estimated.reshape((-1,) + values.shape[1:]), alpha
+
+    def interpolate_batch(self, values, station_ids=None, alphas=None, criterion="loo"):
+        """Interpolate a (time, variables, stations) tensor of readings onto the grid at once.
+
+        NaN marks a missing reading. The (time, variable) slices with the same stations
+        reporting are solved together against one factorization, and the spline
+        parameters of all slices go through the grid kernel in a single matrix product.
+        With alphas, every slice gets the alpha of alphas with the lowest leave-one-out
+        (or GCV) error instead of self.alpha, from one smoothing path per set of stations.
+        Returns (time, variables, grid).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        num_times, num_variables, num_stations = values.shape
+        stations = np.array(self._subset(station_ids))
+        flat = values.reshape(-1, num_stations)
+        num_terms = self.features.n_output_features
+        # Parameters over the whole network; a station without a reading has zero weight
+        parameters = np.zeros((len(self.station_ids) + num_terms, len(flat)))
+        reported = np.ones(len(flat), dtype=bool)
+        patterns, inverse = np.unique(np.isnan(flat), axis=0, return_inverse=True)
+        for p, missing in enumerate(patterns):
+            slices = np.nonzero(inverse.reshape(-1) == p)[0]
+            present = np.nonzero(~missing)[0]
+            if len(present) == 0:
+                reported[slices] = False
+                continue
+            subset = tuple(stations[present].tolist())
+            readings = flat[slices][:, present].T
+            if alphas is None:
+                solution = self._weights(readings, subset)
+            else:
+                path = self.smoothing_path(subset)
+                solution = path.parameters(readings, path.best_alpha(readings, alphas, criterion))
+            parameters[np.ix_(stations[present], slices)] = solution[:len(present)]
+            parameters[-num_terms:, slices] = solution[len(present):]
+        result = (self.grid_kernel @ parameters).T
+        result[~reported] = np.nan
+        return result.reshape(num_times, num_variables, -1)
+
+    def weights(self, values, station_ids=None):
+        """Spline parameters (stations + polynomial terms, v), like ThinPlateSpline.parameters."""
+        return self._weights(values, self._subset(station_ids))
+
+    def _weights(self, values, subset):
+        values = np.asarray(values, dtype=np.float64)
+        rhs = np.zeros((len(subset) + self.features.n_output_features,) + values.shape[1:])
+        rhs[:len(subset)] = values
+        return lu_solve(self.factorization(subset), rhs)
+
+    def factorization(self, subset):
+        """LU factorization of the station system of a tuple of station indices, cached."""
+        if subset in self.factorizations:
+            self.factorizations.move_to_end(subset)
+            return self.factorizations[subset]
+        factorization = lu_factor(self.system(subset))
+        self.factorizations[subset] = factorization
+        if len(self.factorizations) > self.max_factorizations:
+            self.factorizations.popitem(last=False)
+        return factorization
+
+    def operator(self, subset):
+        """(grid, stations) operator taking readings of a tuple of station indices to the grid, cached."""
+        if subset in self.operators:
+            self.operators.move_to_end(subset)
+            return self.operators[subset]
+        if len(subset) == len(self.station_ids):
+            operator = self._cached("operator", lambda: self._build_operator(subset), self.station_locations[list(subset)],
+                                    self.grid_points, np.array([self.alpha]))["operator"]
+        else:
+            operator = self._build_operator(subset)["operator"]
+        self.operators[subset] = operator
+        if len(self.operators) > self.max_operators:
+            self.operators.popitem(last=False)
+        return operator
+
+    def smoothing_path(self, subset):
+        """SmoothingPath of a tuple of station indices, cached."""
+        if subset in self.smoothing_paths:
+            self.smoothing_paths.move_to_end(subset)
+            return self.smoothing_paths[subset]
+        path = SmoothingPath(self.station_locations[list(subset)], self.order, self.enforce_tps_kernel)
+        self.smoothing_paths[subset] = path
+        if len(self.smoothing_paths) > self.max_factorizations:
+            self.smoothing_paths.popitem(last=False)
+        return path
+
+    def system(self, subset):
+        """The station system A = [[K + alpha I, P], [P^T, 0]] of ThinPlateSpline.fit."""
+        locations = self.station_locations[list(subset)]
+        n = len(locations)
+        polynomial = self.features.transform(locations)
+        kernel = tps_kernel(locations, locations, self.order, self.enforce_tps_kernel)
+        return np.vstack([
+            np.hstack([kernel + self.alpha * np.eye(n), polynomial]),
+            np.hstack([polynomial.T, np.zeros((polynomial.shape[1], polynomial.shape[1]))]),
+        ])
+
+    def _subset(self, station_ids):
+        if station_ids is None:
+            return tuple(range(len(self.station_ids)))
+        return tuple(self.station_index[station_id] for station_id in station_ids)
+
+    def _build_grid_kernel(self):
+        kernel = tps_kernel(self.grid_points, self.station_locations, self.order, self.enforce_tps_kernel)
+        return {"kernel": np.hstack([kernel, self.features.transform(self.grid_points)])}
+
+    def _columns(self, subset):
+        # Columns of the cached grid kernel for these stations, plus the polynomial terms
+        num_stations = len(self.station_ids)
+        return list(subset) + list(range(num_stations, num_stations + self.features.n_output_features))
+
+    def _build_operator(self, subset):
+        # Readings only enter the right-hand side rows of the stations, the rest is zero
+        solution = self._weights(np.eye(len(subset)), subset)
+        return {"operator": self.grid_kernel[:, self._columns(subset)] @ solution}
+
+    def _cached(self, kind, build, *key_arrays):
+        key = hashlib.sha256(f"{kind}:{self.order}:{self.enforce_tps_kernel}".encode())
+        for array in key_arrays:
+            key.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+        path = os.path.join(self.cache_dir, f"{kind}_{key.hexdigest()}.npz")
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return dict(cached)
+        arrays = build()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        return arrays
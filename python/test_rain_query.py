@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from radar_store import open_store
+from rain_query import RainQuery
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LATITUDES = np.linspace(1.47, 1.14, 8)
+LONGITUDES = np.linspace(103.55, 104.1, 10)
+
+
+def write_frames(path, times, value):
+    frames = np.full((len(times), len(LATITUDES), len(LONGITUDES)), value, dtype=np.float64)
+    with open_store(path, mode="a") as store:
+        return store.append(frames, times, LATITUDES, LONGITUDES)
+
+
+def test_writer_appends_while_query_is_live(tmp_path):
+    path = str(tmp_path / "rain.h5")
+    write_frames(path, ["2024-05-27T14:00", "2024-05-27T14:05"], 3)
+    rain = RainQuery(path)
+    assert len(rain.query([1.3], [103.8], hours=1)["times"]) == 2
+
+    # A writer in another process, as radar_tail or radar_backfill would be
+    writer = (f"import sys; sys.path.insert(0, {HERE!r}); "
+              f"from test_rain_query import write_frames; "
+              f"sys.exit(0 if write_frames({path!r}, ['2024-05-27T14:10'], 7) == 1 else 1)")
+    subprocess.run([sys.executable, "-c", writer], check=True, timeout=60)
+
+    result = rain.query([1.3], [103.8], hours=1)
+    assert len(result["times"]) == 3
+    assert result["points"][0]["magnitudes"] == [3, 3, 7]
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "rain.h5")
+    open_store(path, mode="a").close()
+    result = RainQuery(path).query([1.3], [103.8], hours=2)
+    assert result["times"] == []
+    assert result["points"][0]["inside"] is False
+    assert result["points"][0]["magnitudes"] == []
+
+
+def test_missing_store(tmp_path):
+    path = str(tmp_path / "rain.h5")
+    rain = RainQuery(path)
+    assert rain.query([1.3], [103.8], hours=2)["times"] == []
+
+    write_frames(path, ["2024-05-27T14:00"], 3)
+    assert rain.query([1.3], [103.8], hours=2)["points"][0]["magnitudes"] == [3]
+    os.remove(path)
+    assert rain.query([1.3], [103.8], hours=2)["times"] == []
+
+
+def test_window_follows_appends(tmp_path):
+    path = str(tmp_path / "rain.h5")
+    write_frames(path, ["2024-05-27T14:00", "2024-05-27T14:30"], 1)
+    rain = RainQuery(path, hot_hours=1)
+    # Appended after the window, then 14:00 falls out of it
+    write_frames(path, ["2024-05-27T15:10"], 2)
+    rain.refresh()
+    # Stored into the window, behind its latest frame
+    write_frames(path, ["2024-05-27T14:45"], 3)
+    rain.refresh()
+    fresh = RainQuery(path, hot_hours=1)
+    assert np.array_equal(rain.hot_epochs, fresh.hot_epochs)
+    assert np.array_equal(rain.hot_frames, fresh.hot_frames)
+    assert rain.query([1.3], [103.8], hours=1)["points"][0]["magnitudes"] == [1, 3, 2]
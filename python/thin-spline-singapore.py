@@ -1,57 +1,47 @@
 import json
 import numpy as np
-from tps import ThinPlateSpline
+from grid_file import write_grid
+from region_raster import cached_mask
+from station_store import StationStore
+from station_tps import StationInterpolator, fill_grid, grid_points
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
-import requests
+from http_cache import HttpCache
 
 # Load from data.gov.sg
 url = "https://api.data.gov.sg/v1/environment/rainfall"
 # url = "https://api.data.gov.sg/v1/environment/air-temperature"
 # url = "https://api.data.gov.sg/v1/environment/wind-speed"
-response = requests.get(url)
-
-if response.status_code == 200:
-    data = response.json()
+# The endpoint serves the latest readings, so always revalidate the cached copy (ETag / If-Modified-Since)
+http_cache = HttpCache("cache")
+try:
+    data = http_cache.get_json(url, max_age=0)
     print("Data saved successfully")
     print(data["items"][0]["timestamp"])
-else:
-    print("Failed to fetch data:", response.status_code)
+except Exception as e:
+    print(e)
 
 # Test: Load data from JSON file
 with open("weather_data.json", "r") as file:
     data = json.load(file)
 
-# Extract station locations and rainfall values
-stations = data["metadata"]["stations"]
-station_locations = np.array([(station["location"]["latitude"], station["location"]["longitude"]) for station in stations])
-rainfall_values = np.array([reading["value"] for reading in data["items"][0]["readings"]])
+# Extract station locations and rainfall values, matched by station ID (stations without a reading are left out)
+with StationStore("outputs/station_readings.h5") as store:
+    store.ingest("rainfall", data)
+    timestamp, station_ids, station_locations, rainfall_values = store.latest("rainfall", data["items"][0]["timestamp"])
+    # The whole network, so the grid and the cached TPS operators do not change when a station drops out
+    network_ids, network_locations = store.station_ids, store.station_locations
 
 # Find northernmost, southernmost, westernmost, and easternmost stations
 buffer = .1
-north = np.max(station_locations[:, 0])+ buffer
-south = np.min(station_locations[:, 0])- buffer
-east = np.max(station_locations[:, 1])+ buffer
-west = np.min(station_locations[:, 1])- buffer
+north = np.max(network_locations[:, 0])+ buffer
+south = np.min(network_locations[:, 0])- buffer
+east = np.max(network_locations[:, 1])+ buffer
+west = np.min(network_locations[:, 1])- buffer
 
 # Create a grid covering the area defined by the outermost stations
 grid_lat = np.linspace(south, north, 100)  # Define latitude range
 grid_lon = np.linspace(west, east, 100)  # Define longitude range
-grid_points = np.array(np.meshgrid(grid_lat, grid_lon)).reshape(2, -1).T
-
-# Fit TPS model
-tps = ThinPlateSpline(alpha=0.0)
-tps.fit(station_locations, rainfall_values)
-
-# Transform grid points
-estimated_rainfall = tps.transform(grid_points)
-
-# Reshape estimated rainfall to match grid shape
-estimated_grid_transposed = estimated_rainfall.reshape(len(grid_lat), len(grid_lon)).T
-estimated_rainfall_grid = np.flip(estimated_grid_transposed, axis=0)
-
-# Clip negative values
-estimated_rainfall_grid[estimated_rainfall_grid < 0] = 0.01
 
 # Load Singapore boundary from GeoJSON file
 with open("singapore_boundary.geojson", "r") as file:
@@ -59,9 +49,24 @@ with open("singapore_boundary.geojson", "r") as file:
 # Extract boundary coordinates
 boundary_coordinates = np.array(singapore_boundary_data["geometry"]["coordinates"][0])
 
-# Plot rain map
+# Masked grid: only cells inside the boundary are interpolated and written out (the mask is cached)
+land = cached_mask(singapore_boundary_data["geometry"], grid_lat, grid_lon)
+
+# TPS interpolation; the station system and grid kernel are cached for this network and grid
+interpolator = StationInterpolator(network_locations, grid_points(grid_lat, grid_lon, land), station_ids=network_ids)
+# Only the reporting stations are fitted; alpha picked per reading set by exact leave-one-out error
+estimated_rainfall, alpha = interpolator.interpolate_tuned(rainfall_values, station_ids)
+print("TPS alpha:", alpha[0])
+
+# Back to a (lat, lon) grid, NaN outside the mask
+estimated_rainfall_grid = fill_grid(estimated_rainfall, land)
+
+# Clip negative values
+estimated_rainfall_grid[estimated_rainfall_grid < 0] = 0.01
+
+# Plot rain map, north up
 plt.figure(figsize=(10, 8))
-plt.imshow(estimated_rainfall_grid, extent=[grid_lon.min(), grid_lon.max(), grid_lat.min(), grid_lat.max()])
+plt.imshow(np.flip(estimated_rainfall_grid, axis=0), extent=[grid_lon.min(), grid_lon.max(), grid_lat.min(), grid_lat.max()])
 # plt.imshow(estimated_rainfall_grid, extent=[grid_lon.min(), grid_lon.max(), grid_lat.min(), grid_lat.max()], norm=colors.LogNorm(vmin=0.01, vmax=5))
 plt.plot(boundary_coordinates[:, 0], boundary_coordinates[:, 1], color='red', linewidth=2)  # Plot Singapore boundary
 plt.colorbar(label='Estimated Rainfall (mm)')
@@ -72,8 +77,9 @@ plt.title('Estimated Rainfall Map of Singapore')
 # Plot weather stations
 plt.scatter(station_locations[:, 1], station_locations[:, 0], color='red', marker='.', label='Weather Stations')
 
-plt.show()
+# Save before showing, the figure is gone once the window is closed
 plt.savefig('singapore_rain.png')
+plt.show()
 
 # output_data = []
 # output_data.append()
@@ -90,27 +96,7 @@ plt.savefig('singapore_rain.png')
 # with open("outputs/estimated_rainfall.json", "w") as outfile:
 #     json.dump(output_data, outfile, indent=4)
 
-geojson_data = {
-    "type": "FeatureCollection",
-    "features": []
-}
-
-for i in range(len(grid_lat)):
-    for j in range(len(grid_lon)):
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [grid_lon[j], grid_lat[i]]  # Note the order of coordinates (lon, lat)
-            },
-            "properties": {
-                "estimated_rainfall": estimated_rainfall_grid[i][j]
-            }
-        }
-        geojson_data["features"].append(feature)
-
-# Save estimated rainfall grid to GeoJSON file
-with open("outputs/estimated_rainfall.geojson", "w") as outfile:
-    json.dump(geojson_data, outfile, indent=4)
-
-
+# Save estimated rainfall grid as a binary grid file (float32 values, grid origin/step, time)
+write_grid("outputs/estimated_rainfall.grid", estimated_rainfall_grid[np.newaxis], grid_lat, grid_lon, [timestamp],
+           "estimated_rainfall")
+# The GeoJSON points, on demand: python grid_file.py outputs/estimated_rainfall.grid --geojson outputs/estimated_rainfall.geojson
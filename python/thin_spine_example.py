@@ -6,6 +6,8 @@ import tqdm  # type: ignore
 
 from tps import ThinPlateSpline
 
+from local_rbf import LocalRBF
+
 
 def compute_time(f, n, *args, **kwargs):
     elapsed_time = 0.0
@@ -43,6 +45,29 @@ def main_timed():
     print(f"Transform avg time: {transform_time}")
 
 
+def main_local_timed():
+    """Compare LocalRBF with ThinPlateSpline as the number of control points grows
+
+    (Global TPS is skipped past 3200 points, its fit is O(n^3))
+    """
+
+    def f(x):
+        return np.sin(3 * x[:, 0]) * np.cos(2 * x[:, 1]) + 0.5 * x[:, 0]
+
+    rng = np.random.RandomState(0)  # pylint: disable=no-member
+    X = rng.uniform(0, 1, (5000, 2))
+
+    for n_c in [800, 3200, 12800, 51200]:
+        X_c = rng.uniform(0, 1, (n_c, 2))
+        models = [("LocalRBF", LocalRBF())] + ([("ThinPlateSpline", ThinPlateSpline())] if n_c <= 3200 else [])
+        print(f"Control point number: {n_c}")
+        for name, model in models:
+            fit_time = compute_time(model.fit, 3, X_c, f(X_c))
+            transform_time = compute_time(model.transform, 3, X)
+            rmse = np.sqrt(np.mean((model.transform(X)[:, 0] - f(X)) ** 2))
+            print(f"{name}: fit avg time {fit_time:.3f}s, transform avg time {transform_time:.3f}s, rmse {rmse:.2e}")
+
+
 def main_interpolation():
     """Interpolates a function
 
@@ -106,11 +131,12 @@ def main_surface_mapping():
     plt.scatter(deform_xy[:, 0], deform_xy[:, 1])
     plt.plot(transformed_xy[:, 0], transformed_xy[:, 1], c="orange")
 
-    plt.show()
     plt.savefig('tps_plot_3d.png')
+    plt.show()
 
 
 if __name__ == "__main__":
     main_surface_mapping()
     main_interpolation()
-    main_timed()
\ No newline at end of file
+    main_timed()
+    main_local_timed()
\ No newline at end of file
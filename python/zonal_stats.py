@@ -0,0 +1,141 @@
+import argparse
+import csv
+
+import numpy as np
+
+from radar_store import NODATA, from_epoch, open_store
+from region_raster import cached_mask, load_regions
+
+
+class ZonalStats:
+    """Per-region rainfall statistics over the radar grid.
+
+    Every region is rasterized once onto the grid (and cached on disk), and the masks are
+    packed into as few label rasters as possible: regions that do not overlap share a
+    layer, so Singapore and its sub-regions need two. A stack of frames is then reduced
+    with one bincount per layer and statistic, with no point-in-polygon work per frame.
+
+    Statistics per frame and region:
+        coverage  fraction of the region's cells with rain
+        mean      mean magnitude over the raining cells (NaN when dry)
+        max       maximum magnitude (NaN when dry)
+
+    Usage:
+        zonal = ZonalStats(load_regions("singapore_boundary.geojson"), latitudes, longitudes)
+        stats = zonal.frame_stats(magnitudes)
+        stats["coverage"][:, zonal.names.index("Singapore")]
+    """
+
+    def __init__(self, regions, latitudes, longitudes, cache_dir="cache/regions"):
+        self.names = list(regions)
+        self.shape = (len(latitudes), len(longitudes))
+        masks = [cached_mask(regions[name], latitudes, longitudes, cache_dir).ravel() for name in self.names]
+        self.cells = np.array([mask.sum() for mask in masks])
+
+        # Greedily put each region in the first layer it does not overlap
+        layers = []
+        for k, mask in enumerate(masks):
+            for layer in layers:
+                if not (layer["covered"] & mask).any():
+                    break
+            else:
+                layer = {"covered": np.zeros(mask.shape, dtype=bool), "regions": []}
+                layers.append(layer)
+            layer["covered"] |= mask
+            layer["regions"].append(k)
+
+        # Per layer: the flat indices of the cells inside some region, and their region
+        self.layers = []
+        for layer in layers:
+            labels = np.full(masks[0].shape, -1, dtype=np.int64)
+            for position, k in enumerate(layer["regions"]):
+                labels[masks[k]] = position
+            cells = np.nonzero(labels >= 0)[0]
+            self.layers.append((cells, labels[cells], np.array(layer["regions"])))
+
+    def frame_stats(self, magnitudes):
+        """Statistics of one (rows, cols) frame or a (time, rows, cols) stack.
+
+        Magnitudes are floats with NaN for no rain, or the store's raw uint8 values.
+        Returns {"coverage", "mean", "max"}, each (regions,) for one frame or
+        (time, regions) for a stack, in the order of self.names.
+        """
+        magnitudes = np.asarray(magnitudes)
+        single = magnitudes.ndim == 2
+        frames = magnitudes.reshape(-1, self.shape[0] * self.shape[1])
+        num_frames, num_regions = len(frames), len(self.names)
+
+        rain_cells = np.zeros((num_frames, num_regions))
+        sums = np.zeros((num_frames, num_regions))
+        maxima = np.zeros((num_frames, num_regions))
+        for cells, labels, regions in self.layers:
+            values = frames[:, cells]
+            raining = values != NODATA if values.dtype == np.uint8 else ~np.isnan(values)
+            # One flat bin per (frame, region) so the whole stack reduces in one pass
+            bins = (np.arange(num_frames)[:, None] * len(regions) + labels)[raining]
+            rain_values = values[raining].astype(np.float64)
+            size = num_frames * len(regions)
+            rain_cells[:, regions] = np.bincount(bins, minlength=size).reshape(num_frames, -1)
+            sums[:, regions] = np.bincount(bins, rain_values, minlength=size).reshape(num_frames, -1)
+            # Magnitudes are positive, so 0 is a safe start for the maximum of dry regions
+            layer_max = np.zeros(size)
+            np.maximum.at(layer_max, bins, rain_values)
+            maxima[:, regions] = layer_max.reshape(num_frames, -1)
+
+        dry = rain_cells == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats = {
+                "coverage": rain_cells / self.cells,
+                "mean": np.where(dry, np.nan, sums / rain_cells),
+                "max": np.where(dry, np.nan, maxima),
+            }
+        if single:
+            stats = {key: value[0] for key, value in stats.items()}
+        return stats
+
+    def store_stats(self, store, start=None, end=None, batch_frames=256):
+        """Statistics of the stored frames in a time window, read batch_frames at a time.
+
+        Returns (times, stats) with stats as in frame_stats.
+        """
+        times = from_epoch(store.epochs[store.frame_indices(start, end)])
+        results = []
+        for i in range(0, len(times), batch_frames):
+            batch = times[i:i + batch_frames]
+            frames, _, _, _ = store.read(batch[0], batch[-1], raw=True)
+            results.append(self.frame_stats(frames))
+        if not results:
+            return times, {key: np.zeros((0, len(self.names))) for key in ("coverage", "mean", "max")}
+        return times, {key: np.concatenate([r[key] for r in results]) for key in results[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-region rainfall statistics from the radar store")
+    parser.add_argument("--store", default="outputs/rainfall_magnitudes.h5")
+    parser.add_argument("--regions", nargs="+", default=["singapore_boundary.geojson"],
+                        help="GeoJSON files of regions (Feature or FeatureCollection)")
+    parser.add_argument("--start", help="first frame time, e.g. 2024-05-27T12:00")
+    parser.add_argument("--end", help="last frame time")
+    parser.add_argument("--output", default="outputs/zonal_stats.csv")
+    args = parser.parse_args()
+
+    regions = {}
+    for regions_file in args.regions:
+        regions.update(load_regions(regions_file))
+
+    with open_store(args.store, mode="r") as store:
+        zonal = ZonalStats(regions, store.latitudes, store.longitudes)
+        times, stats = zonal.store_stats(store, args.start, args.end)
+
+    with open(args.output, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["time", "region", "coverage", "mean", "max"])
+        for t, time in enumerate(times):
+            for k, name in enumerate(zonal.names):
+                writer.writerow([str(time), name, f"{stats['coverage'][t, k]:.4f}",
+                                 f"{stats['mean'][t, k]:.3f}", f"{stats['max'][t, k]:g}"])
+    print(f"Zonal statistics saved: {args.output}")
+
+
+if __name__ == "__main__":
+    main()